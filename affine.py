@@ -0,0 +1,127 @@
+"""Single-resample geometric augmentation.
+
+A view built by `[RandomResizedCrop, RandomHorizontalFlip, ..., RandAugment, ToTensor, Normalize]`
+resamples the image once for the crop, copies it for the flip and resamples it again for every
+shear / translate / rotate op RandAugment draws. `FusedAffineTransform` samples all of those
+up front, composes them into one output -> source affine matrix and warps the source once:
+
+* the crop region is box-reduced by the largest integer factor that keeps it >= the output
+  size (one pass over the crop only), so the warp never minifies by 2x or more;
+* everything outside the crop is the RandAugment fill colour, as with the chained ops. Corners
+  an earlier op filled and a later op moves back into view now show image content instead;
+* the colour ops (jitter, grayscale, RandAugment colour ops) then run through `ColorPlan`.
+
+Geometric ops are moved ahead of the colour ops they were interleaved with. The colour ops are
+point-wise apart from sharpness, so this only changes what they do to the fill colour and the
+statistics contrast / auto_contrast / equalize read from it. Views that draw no RandAugment
+geometric op keep the plain box-filtered crop and flip.
+"""
+import math
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision.transforms import transforms
+from torchvision.transforms import functional as F
+
+from colorlut import ColorPlan, FusedColorTransform, sample_color_ops
+from randaugment import RandAugment, _interpolation
+
+_GEOMETRIC_OPS = ('Rotate', 'ShearX', 'ShearY', 'TranslateX', 'TranslateY', 'TranslateXRel', 'TranslateYRel')
+_TENSOR_TRANSFORMS = (transforms.ToTensor, transforms.PILToTensor)
+
+
+def op_matrix(name, args, size):
+    """3x3 output -> input matrix of RandAugment op `name` on an image of `size`, as PIL applies it."""
+    w, h = size
+    m = np.eye(3)
+    if name == 'ShearX':
+        m[0, 1] = args[0]
+    elif name == 'ShearY':
+        m[1, 0] = args[0]
+    elif name in ('TranslateX', 'TranslateXRel'):
+        m[0, 2] = args[0] * w if name.endswith('Rel') else args[0]
+    elif name in ('TranslateY', 'TranslateYRel'):
+        m[1, 2] = args[0] * h if name.endswith('Rel') else args[0]
+    elif name == 'Rotate':
+        # Image.rotate: about the centre, expand=False
+        angle = -math.radians(args[0])
+        cos, sin = math.cos(angle), math.sin(angle)
+        cx, cy = w / 2.0, h / 2.0
+        m[:2, :2] = [[cos, sin], [-sin, cos]]
+        m[0, 2] = cx - cos * cx - sin * cy
+        m[1, 2] = cy + sin * cx - cos * cy
+    else:
+        raise ValueError('{} is not a geometric op'.format(name))
+    return m
+
+
+def _flip_matrix(width):
+    return np.array([[-1., 0., width], [0., 1., 0.], [0., 0., 1.]])
+
+
+class FusedAffineTransform(object):
+    """Drop-in for `transforms.Compose` of a `[RandomResizedCrop, ...]` augmentation list"""
+
+    def __init__(self, transforms_list):
+        transforms_list = list(transforms_list)
+        assert isinstance(transforms_list[0], transforms.RandomResizedCrop)
+        self.crop = transforms_list[0]
+        self.interpolation = F.pil_modes_mapping.get(self.crop.interpolation, self.crop.interpolation)
+        split = next((k for k, t in enumerate(transforms_list) if isinstance(t, _TENSOR_TRANSFORMS)),
+                     len(transforms_list))
+        self.augment = []
+        for t in transforms_list[1:split]:
+            # colour runs are planned through `ColorPlan` here anyway
+            self.augment.extend(t.transforms if isinstance(t, FusedColorTransform) else [t])
+        self.post = transforms.Compose(transforms_list[split:])
+
+    def _sample(self, size):
+        """Sample the augmentations, returns (matrix, flip, resample, fillcolor, colour ops)."""
+        matrix, flip, resample, fillcolor, ops = np.eye(3), False, None, None, []
+        for t in self.augment:
+            if isinstance(t, transforms.RandomHorizontalFlip):
+                if torch.rand(1) < t.p:
+                    flip = not flip
+                    matrix = matrix.dot(_flip_matrix(size[0]))
+            elif isinstance(t, RandAugment):
+                for op in t.sample_ops():
+                    level_args = op.sample()
+                    if level_args is None:
+                        continue
+                    if op.name in _GEOMETRIC_OPS:
+                        matrix = matrix.dot(op_matrix(op.name, level_args, size))
+                        if resample is None:
+                            resample = _interpolation(dict(op.kwargs))
+                            fillcolor = op.kwargs.get('fillcolor')
+                    else:
+                        ops.append((op.name, level_args, op.aug_fn, op.kwargs))
+            else:
+                sample_color_ops(t, ops)
+        return matrix, flip, resample, fillcolor, ops
+
+    def _warp(self, img, box, size, matrix, resample, fillcolor):
+        j, i, w, h = box
+        factor = max(1, int(min(w / size[0], h / size[1])))
+        x0, y0, x1, y1 = int(j), int(i), int(math.ceil(j + w)), int(math.ceil(i + h))
+        # output -> crop -> (reduced) source region coordinates
+        crop = np.array([[w / size[0], 0., j - x0], [0., h / size[1], i - y0], [0., 0., 1.]])
+        data = np.diag([1. / factor, 1. / factor, 1.]).dot(crop).dot(matrix)[:2].reshape(-1)
+        src = img.reduce(factor, box=(x0, y0, x1, y1)) if factor > 1 else img.crop((x0, y0, x1, y1))
+        return src.transform(size, Image.AFFINE, tuple(data), resample=resample, fillcolor=fillcolor)
+
+    def __call__(self, img, params=None):
+        i, j, h, w = params or self.crop.get_params(img, self.crop.scale, self.crop.ratio)
+        size = tuple(self.crop.size[::-1])
+        matrix, flip, resample, fillcolor, ops = self._sample(size)
+        if resample is None:
+            # no RandAugment geometric op: box-filtered crop and a flip, as the chained transforms
+            img = img.resize(size, self.interpolation, box=(j, i, j + w, i + h))
+            if flip:
+                img = img.transpose(Image.FLIP_LEFT_RIGHT)
+        else:
+            img = self._warp(img, (j, i, w, h), size, matrix, resample, fillcolor)
+        return self.post(ColorPlan(img).run(ops))
+
+    def __repr__(self):
+        return '{}({}, {}, {})'.format(self.__class__.__name__, self.crop, self.augment, self.post)
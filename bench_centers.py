@@ -0,0 +1,177 @@
+"""Throughput and fidelity of class-center subsampling (main.py --center_negatives / --center_refresh).
+
+Times the part of a training step that depends on the number of classes, i.e. projecting the
+centers through head_fc1 / head_fc2 and the BalSCL loss with its backward, on random
+normalized features standing in for the encoder output. Fidelity is reported against the
+full version: the loss, and the cosine similarity of the fc.weight gradient averaged over steps.
+
+Accuracy is compared on a synthetic long-tailed task (ImageNet-LT-like class counts from 1280
+down to 5): every class is a random prototype, samples and their 8 views are noisy copies, and a
+linear layer stands in for the encoder. Each run trains the same initialization on the same
+class-imbalanced batches for `--train_steps` steps with the CE + BalSCL loss of main.py, then
+reports top-1 and many / medium / few-shot accuracy on a balanced held-out set.
+
+    python bench_centers.py --num_classes 8142 --batch_size 64 --negatives 1024 --refresh 10
+"""
+import argparse
+import copy
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from loss.centers import CenterSampler
+from loss.contrastive import BalSCL
+from loss.logitadjust import LogitAdjust
+from models.resnext import BCLModel
+from utils import ShotAccuracy
+
+parser = argparse.ArgumentParser(description='class-center subsampling benchmark')
+parser.add_argument('--num_classes', default=8142, type=int)
+parser.add_argument('--batch_size', default=64, type=int, help='images per step (8 views each)')
+parser.add_argument('--negatives', default=[1024], type=int, nargs='+', help='sampled negative centers')
+parser.add_argument('--refresh', default=10, type=int, help='cache refresh period for the cached runs')
+parser.add_argument('--steps', default=20, type=int)
+parser.add_argument('--temp', default=0.07, type=float)
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+parser.add_argument('--train_steps', default=300, type=int, help='training steps per run of the accuracy comparison')
+parser.add_argument('--lr', default=0.1, type=float)
+parser.add_argument('--input_dim', default=128, type=int, help='dimension of the synthetic samples')
+parser.add_argument('--noise', default=1.5, type=float, help='sample noise relative to the prototypes')
+parser.add_argument('--eval_per_class', default=4, type=int, help='held-out samples per class')
+
+
+def step(model, criterion, features, targets, sampler=None):
+    """One center projection + loss + backward, returns (loss, fc.weight gradient)."""
+    model.zero_grad()
+    labels, scale, classes = None, None, None
+    if sampler is not None:
+        sampler.refresh(model.refresh_centers)
+        classes, labels, scale = sampler.sample(targets)
+    centers = model.project_centers(classes, sampler.stats if sampler is not None else None)
+    if sampler is not None:
+        centers = sampler.centers(list(centers), labels)
+    loss = criterion.forward_pairs(list(centers), features, targets, center_labels=labels, center_scale=scale)
+    loss.backward()
+    return loss.item(), model.fc.weight.grad.clone()
+
+
+def long_tail_counts(num_classes, most=1280, fewest=5):
+    """Exponentially decaying class sizes, like ImageNet-LT."""
+    return [int(most * (fewest / float(most)) ** (c / max(1., num_classes - 1.))) for c in range(num_classes)]
+
+
+def train_and_eval(model, encoder, counts, prototypes, args, sampler=None):
+    """Train `model` / `encoder` in place with CE + BalSCL, return (steps/s, top1, many, med, few)."""
+    device = prototypes.device
+    criterion_ce = LogitAdjust(counts).to(device)
+    criterion_scl = BalSCL(counts, args.temp)
+    params = list(model.parameters()) + list(encoder.parameters())
+    optimizer = torch.optim.SGD(params, args.lr, momentum=0.9, weight_decay=5e-4)
+    prior = torch.tensor(counts, dtype=torch.float, device=device)
+    # the same batches and negative draws for every run
+    generator = torch.Generator(device='cpu').manual_seed(2)
+    torch.manual_seed(3)
+    model.train()
+    start = time.time()
+    for _ in range(args.train_steps):
+        labels = torch.multinomial(prior.cpu(), args.batch_size, replacement=True, generator=generator).to(device)
+        noise = torch.randn(9, args.batch_size, prototypes.shape[1], generator=generator).to(device)
+        x = prototypes[labels] + args.noise * noise
+        feat = encoder(x.view(-1, x.shape[-1])).view(9, args.batch_size, -1)
+        logits = model.fc(feat[0])
+        # views ordered (view, sample) like the stitched quadrants in main.py
+        targets = labels.repeat(8)
+        feat_mlp1_ = model.head1(feat[1:].reshape(8 * args.batch_size, -1))
+        feat_mlp1 = F.normalize(feat_mlp1_, dim=1)
+        feat_mlp2 = F.normalize(model.head2(feat_mlp1_), dim=1)
+        features = [f.view(8, args.batch_size, -1).transpose(0, 1) for f in (feat_mlp1, feat_mlp2)]
+
+        labels_c, scale, classes, stats = None, None, None, None
+        if sampler is not None:
+            sampler.refresh(model.refresh_centers)
+            classes, labels_c, scale = sampler.sample(targets)
+            stats = sampler.stats
+        centers = model.project_centers(classes, stats)
+        if sampler is not None:
+            centers = sampler.centers(list(centers), labels_c)
+        scl_loss = criterion_scl.forward_pairs(list(centers), features, targets, center_labels=labels_c,
+                                               center_scale=scale)
+        loss = criterion_ce(logits, labels) + 0.5 * scl_loss
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    steps_per_s = args.train_steps / (time.time() - start)
+
+    generator.manual_seed(4)
+    labels = torch.arange(args.num_classes).repeat_interleave(args.eval_per_class).to(device)
+    x = prototypes[labels] + args.noise * torch.randn(len(labels), prototypes.shape[1], generator=generator).to(device)
+    with torch.no_grad():
+        preds = model.fc(encoder(x)).argmax(1)
+    top1 = (preds == labels).float().mean().item()
+    many, med, few = ShotAccuracy(counts)(preds, labels)
+    return steps_per_s, top1, many, med, few
+
+
+def main():
+    args = parser.parse_args()
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    model = BCLModel(num_classes=args.num_classes).to(device).train()
+    counts = long_tail_counts(args.num_classes)
+    criterion = BalSCL(counts, args.temp)
+
+    batches = []
+    for _ in range(args.steps):
+        targets = torch.randint(0, args.num_classes, (8 * args.batch_size,), device=device)
+        features = [F.normalize(torch.randn(args.batch_size, 8, 256, device=device), dim=2) for _ in range(2)]
+        batches.append((features, targets))
+
+    runs = [('full', None, 0)]
+    for k in args.negatives:
+        runs += [('sampled {}'.format(k), k, 0), ('cached {} / {}'.format(k, args.refresh), k, args.refresh)]
+
+    reference = []
+    print('{:<22}{:>12}{:>12}{:>12}'.format('run', 'steps/s', 'loss', 'grad cos'))
+    for name, negatives, refresh in runs:
+        sampler = CenterSampler(args.num_classes, negatives, refresh) if negatives else None
+        # every run sees the same weights and batches, the first one as warm-up
+        torch.manual_seed(1)
+        step(model, criterion, *batches[0], sampler=sampler)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.time()
+        losses, cosines = [], []
+        for n, (features, targets) in enumerate(batches):
+            loss, grad = step(model, criterion, features, targets, sampler=sampler)
+            losses.append(loss)
+            if sampler is None:
+                reference.append(grad)
+            else:
+                cosines.append(F.cosine_similarity(grad.view(1, -1), reference[n].view(1, -1)).item())
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        elapsed = time.time() - start
+        print('{:<22}{:>12.2f}{:>12.4f}{:>12}'.format(
+            name, len(batches) / elapsed, sum(losses) / len(losses),
+            '{:.4f}'.format(sum(cosines) / len(cosines)) if cosines else '-'))
+
+    if not args.train_steps:
+        return
+    torch.manual_seed(5)
+    init = BCLModel(num_classes=args.num_classes).to(device)
+    init_encoder = nn.Sequential(nn.Linear(args.input_dim, 2048), nn.ReLU(inplace=True)).to(device)
+    prototypes = torch.randn(args.num_classes, args.input_dim, device=device)
+    print()
+    print('{:<22}{:>12}{:>10}{:>10}{:>10}{:>10}'.format('run', 'train it/s', 'top1', 'many', 'med', 'few'))
+    for name, negatives, refresh in runs:
+        sampler = CenterSampler(args.num_classes, negatives, refresh) if negatives else None
+        result = train_and_eval(copy.deepcopy(init), copy.deepcopy(init_encoder), counts, prototypes, args, sampler)
+        print('{:<22}{:>12.2f}'.format(name, result[0]) + ''.join('{:>10.2f}'.format(a * 100) for a in result[1:]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""Memory vs. recompute trade-off of encoder activation checkpointing (main.py --grad_checkpoint).
+
+Runs training steps of `BCLModel` (forward on B classification images and 2B mosaics,
+backward, SGD step) for every checkpointing mode, each in a fresh process, and reports the
+peak memory of the step and the step time, also relative to the first mode. The peak is
+`torch.cuda.max_memory_allocated` on GPU and the growth of the peak RSS on CPU (Linux).
+
+    python bench_memory.py --arch resnext50 --batch_size 64 --modes none stage block
+"""
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+
+import torch
+
+from models.resnext import BCLModel
+
+parser = argparse.ArgumentParser(description='activation checkpointing memory report')
+parser.add_argument('--arch', default='resnet50', choices=['resnet50', 'resnext50'])
+parser.add_argument('--batch_size', default=16, type=int, help='B, the step runs 3B images')
+parser.add_argument('--size', default=224, type=int, help='image size')
+parser.add_argument('--num_classes', default=1000, type=int)
+parser.add_argument('--modes', default=['none', 'stage', 'block'], nargs='+', choices=['none', 'stage', 'block'])
+parser.add_argument('--checkpoint_stages', default=[1, 2, 3, 4], type=int, nargs='+')
+parser.add_argument('--steps', default=3, type=int, help='timed steps after one warm-up step')
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+parser.add_argument('--mode', default=None, help=argparse.SUPPRESS)
+
+
+def _rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 2. ** 20
+
+
+def measure(args):
+    """Peak step memory (MB) and seconds per step of `args.mode`, in this process."""
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    model = BCLModel(num_classes=args.num_classes, name=args.arch, checkpoint=args.mode,
+                     checkpoint_stages=args.checkpoint_stages).to(device).train()
+    optimizer = torch.optim.SGD(model.parameters(), 0.1, momentum=0.9)
+    x = torch.randn(3 * args.batch_size, 3, args.size, args.size, device=device)
+
+    def step():
+        outputs = model(x, train=True)
+        loss = sum(o.float().square().mean() for o in outputs)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        base = torch.cuda.memory_allocated() / 2. ** 20
+        torch.cuda.reset_peak_memory_stats()
+    else:
+        base = _rss_mb()
+    step()
+    if device.type == 'cuda':
+        peak = torch.cuda.max_memory_allocated() / 2. ** 20
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    start = time.time()
+    for _ in range(args.steps):
+        step()
+    return {'peak_mb': peak - base, 'step_s': (time.time() - start) / args.steps}
+
+
+def main():
+    args = parser.parse_args()
+    if args.mode is not None:
+        print(json.dumps(measure(args)))
+        return
+
+    print('{} batch {} ({} images of {}px) on {}, stages {}'.format(
+        args.arch, args.batch_size, 3 * args.batch_size, args.size, args.device, args.checkpoint_stages))
+    print('{:<8}{:>14}{:>10}{:>12}{:>10}'.format('mode', 'peak MB', 'memory', 's / step', 'time'))
+    reference = None
+    for mode in args.modes:
+        # a fresh process per mode, the CPU peak RSS never goes down
+        out = subprocess.run([sys.executable] + sys.argv + ['--mode', mode], check=True,
+                             stdout=subprocess.PIPE, universal_newlines=True).stdout
+        result = json.loads(out.strip().splitlines()[-1])
+        reference = reference or result
+        print('{:<8}{:>14.0f}{:>10.2f}{:>12.3f}{:>10.2f}'.format(
+            mode, result['peak_mb'], result['peak_mb'] / reference['peak_mb'],
+            result['step_s'], result['step_s'] / reference['step_s']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+"""Background, crash-safe checkpoint writing.
+
+`CheckpointWriter.save` copies the state to CPU memory and returns; a writer thread serializes
+the copy to a temporary file in the same directory, fsyncs it and `os.replace`s it over the
+checkpoint, so the file on disk is always either the previous or the new complete checkpoint.
+The `best` checkpoint is a hard link to the file just written instead of a second copy.
+
+With `keep > 0` every save goes to `<name>.epoch<N>.pth.tar`, only the newest `keep` of those
+are kept and `<name>.pth.tar` is a hard link to the newest. Pruning an epoch file never
+touches the best checkpoint, which is a link of its own. Epoch files already in the directory (a
+resumed run) count towards `keep`, oldest epoch pruned first.
+"""
+import glob
+import os
+import random
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+
+def to_cpu(obj):
+    """Deep copy of `obj` with every tensor copied to CPU memory."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def rng_state():
+    """States of Python `random`, NumPy's global generator (RandAugment), torch and CUDA.
+
+    Plain lists and tensors only, so checkpoints holding it load with `torch.load(weights_only=True)`.
+    """
+    kind, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    state = {'python': random.getstate(),
+             'numpy': [kind, keys.tolist(), pos, has_gauss, cached_gaussian],
+             'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    version, internal, gauss = state['python']
+    random.setstate((version, tuple(internal), gauss))
+    kind, keys, pos, has_gauss, cached_gaussian = state['numpy']
+    np.random.set_state((kind, np.asarray(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def _fsync_dir(directory):
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def atomic_save(state, path):
+    """`torch.save` to a temporary file next to `path`, then rename it over `path`."""
+    tmp = '{}.tmp.{}'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    _fsync_dir(os.path.dirname(os.path.abspath(path)))
+
+
+def atomic_link(src, dst):
+    """Point `dst` at the contents of `src`: a hard link, or a copy where links are not supported."""
+    tmp = '{}.tmp.{}'.format(dst, os.getpid())
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+class CheckpointWriter(object):
+
+    def __init__(self, directory, name='bcl_ckpt', keep=0, background=True):
+        self.directory = directory
+        self.name = name
+        self.keep = keep
+        self.path = os.path.join(directory, '{}.pth.tar'.format(name))
+        self.best_path = os.path.join(directory, '{}.best.pth.tar'.format(name))
+        self.executor = ThreadPoolExecutor(1) if background else None
+        self.pending = None
+        # epoch files left by the run being resumed count towards `keep` too
+        self.retained = self._existing() if keep else []
+
+    def save(self, state, is_best, epoch=None):
+        """Snapshot `state` and write it, in the background unless `background=False`.
+
+        Waits for the previous write first, so at most one snapshot is held in memory, and
+        re-raises its error if it failed.
+        """
+        self.wait()
+        snapshot = to_cpu(state)
+        if self.executor is None:
+            self._write(snapshot, is_best, epoch)
+        else:
+            self.pending = self.executor.submit(self._write, snapshot, is_best, epoch)
+
+    def _write(self, state, is_best, epoch):
+        if self.keep and epoch is not None:
+            target = os.path.join(self.directory, '{}.epoch{}.pth.tar'.format(self.name, epoch))
+            atomic_save(state, target)
+            atomic_link(target, self.path)
+            if target in self.retained:
+                self.retained.remove(target)
+            self.retained.append(target)
+        else:
+            target = self.path
+            atomic_save(state, target)
+        if is_best:
+            atomic_link(target, self.best_path)
+        self._prune()
+
+    def _existing(self):
+        """`<name>.epoch<N>.pth.tar` files already in the directory, oldest epoch first."""
+        pattern = re.compile(r'{}\.epoch(\d+)\.pth\.tar$'.format(re.escape(self.name)))
+        found = []
+        files = os.path.join(glob.escape(self.directory), '{}.epoch*.pth.tar'.format(glob.escape(self.name)))
+        for path in glob.glob(files):
+            match = pattern.match(os.path.basename(path))
+            if match:
+                found.append((int(match.group(1)), path))
+        return [path for _, path in sorted(found)]
+
+    def _prune(self):
+        while len(self.retained) > self.keep:
+            old = self.retained.pop(0)
+            if os.path.exists(old):
+                os.remove(old)
+
+    def wait(self):
+        """Block until the pending write (if any) is on disk."""
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def close(self):
+        self.wait()
+        if self.executor is not None:
+            self.executor.shutdown()
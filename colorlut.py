@@ -0,0 +1,230 @@
+"""Fused colour pipeline: point-wise ops as one LUT, colour-matrix ops as one saturation matrix.
+
+`ColorJitter`, `RandomGrayscale` and the colour ops of `RandAugment` each make a full
+pass (and a full copy) over the image. `FusedColorTransform` samples all of them up
+front, exactly like the chained transforms would, and plans them into stages:
+
+* point-wise ops (brightness, contrast, posterize, solarize, solarize_add, invert,
+  auto_contrast, equalize) compose into one per-channel 256-entry LUT, applied with a
+  single `Image.point`. The data-dependent ones (contrast, auto_contrast, equalize)
+  read their statistics from one histogram of the image, pushed through the pending LUT;
+* colour-matrix ops compose into one 3x3 matrix. Saturation by `f` is `f * I + (1 - f) * G`
+  with `G` the luma projection, and grayscale is saturation 0, so a run of them with every
+  `f` in [0, 1] folds into a single saturation factor and is applied as one
+  `ImageEnhance.Color` (or one grayscale conversion) after the pending LUT. A factor above 1
+  can clip, so it is applied on its own;
+* anything else (hue, sharpness, geometric ops) flushes the pending stages and runs as is.
+
+A lone op of either kind reproduces PIL exactly. Fused matrix runs skip the truncation between
+ops, so every op folded into a run may move the result by one more grey level; the contrast
+mean is taken from the channel histograms and may move it by one grey level too.
+"""
+import numpy as np
+import torch
+from PIL import ImageEnhance
+from torchvision.transforms import transforms
+from torchvision.transforms import functional as F
+
+from randaugment import RandAugment
+
+_LEVELS = np.arange(256, dtype=np.int64)
+# ITU-R 601-2 luma, as used by PIL's "RGB" -> "L"
+_LUMA = np.array([19595, 38470, 7471], dtype=np.float64) / 65536.
+
+_POINT_OPS = ('Brightness', 'Contrast', 'PosterizeOriginal', 'PosterizeResearch', 'PosterizeTpu', 'Solarize',
+              'SolarizeAdd', 'Invert', 'Identity', 'AutoContrast', 'Equalize')
+_MATRIX_OPS = ('Color', 'Grayscale')
+
+
+def _blend_lut(degenerate, factor):
+    # Image.blend in single precision, truncated and clipped
+    out = np.float32(degenerate) + np.float32(factor) * (_LEVELS.astype(np.float32) - np.float32(degenerate))
+    return np.clip(np.floor(out), 0, 255).astype(np.int64)
+
+
+def _auto_contrast_lut(hist):
+    present = np.nonzero(hist)[0]
+    lo, hi = present[0], present[-1]
+    if hi <= lo:
+        return _LEVELS
+    scale = 255.0 / (hi - lo)
+    return np.clip((_LEVELS * scale - lo * scale).astype(np.int64), 0, 255)
+
+
+def _equalize_lut(hist):
+    present = hist[hist > 0]
+    step = (present.sum() - present[-1]) // 255 if len(present) > 1 else 0
+    if not step:
+        return _LEVELS
+    n = step // 2 + np.cumsum(hist) - hist
+    return np.minimum(n // step, 255)
+
+
+def point_lut(name, args, hist=None):
+    """(3, 256) LUT of a point-wise op; `hist` is the (3, 256) histogram of its input."""
+    if name == 'Brightness':
+        lut = _blend_lut(0, args[0])
+    elif name == 'Contrast':
+        mean = int((hist * _LEVELS).sum(1).dot(_LUMA) / hist[0].sum() + 0.5)
+        lut = _blend_lut(mean, args[0])
+    elif name.startswith('Posterize'):
+        bits = args[0]
+        lut = _LEVELS if bits >= 8 else _LEVELS & (~(2 ** (8 - bits) - 1) & 0xFF)
+    elif name == 'Solarize':
+        lut = np.where(_LEVELS < args[0], _LEVELS, 255 - _LEVELS)
+    elif name == 'SolarizeAdd':
+        thresh = args[1] if len(args) > 1 else 128
+        lut = np.where(_LEVELS < thresh, np.minimum(255, _LEVELS + args[0]), _LEVELS)
+    elif name == 'Invert':
+        lut = 255 - _LEVELS
+    elif name == 'Identity':
+        lut = _LEVELS
+    elif name == 'AutoContrast':
+        return np.stack([_auto_contrast_lut(h) for h in hist])
+    elif name == 'Equalize':
+        return np.stack([_equalize_lut(h) for h in hist])
+    else:
+        raise ValueError('{} is not a point-wise op'.format(name))
+    return np.broadcast_to(lut, (3, 256))
+
+
+def saturation_factor(name, args):
+    """Factor `f` of a colour-matrix op, written as `f * I + (1 - f) * G`."""
+    if name == 'Grayscale':
+        return 0.
+    if name == 'Color':
+        return args[0]
+    raise ValueError('{} is not a colour-matrix op'.format(name))
+
+
+class ColorPlan(object):
+    """Runs a list of sampled colour ops on a PIL image with as few full-image passes as possible"""
+
+    def __init__(self, img):
+        self.img = img
+        self.hist = None
+        self.lut = None
+        self.saturation = None
+
+    def _histogram(self):
+        if self.hist is None:
+            self.hist = np.asarray(self.img.histogram(), dtype=np.int64).reshape(3, 256)
+        if self.lut is None:
+            return self.hist
+        # histogram of the image after the pending LUT, without materializing it
+        return np.stack([np.bincount(self.lut[c], weights=self.hist[c], minlength=256)
+                         for c in range(3)]).astype(np.int64)
+
+    def flush(self):
+        if self.lut is not None:
+            self.img = self.img.point(self.lut.reshape(-1).tolist())
+        if self.saturation == 0:
+            self.img = self.img.convert('L').convert('RGB')
+        elif self.saturation is not None:
+            self.img = ImageEnhance.Color(self.img).enhance(self.saturation)
+        if self.lut is not None or self.saturation is not None:
+            self.hist = None
+        self.lut, self.saturation = None, None
+        return self.img
+
+    def point(self, name, args):
+        if self.saturation is not None:
+            self.flush()
+        hist = self._histogram() if name in ('Contrast', 'AutoContrast', 'Equalize') else None
+        lut = point_lut(name, args, hist)
+        self.lut = lut if self.lut is None else np.take_along_axis(lut, self.lut, axis=1)
+
+    def mat(self, name, args):
+        # (a * I + (1 - a) * G)(b * I + (1 - b) * G) = ab * I + (1 - ab) * G, since G is idempotent,
+        # but PIL clips between ops: only convex blends (0 <= f <= 1) stay in range and fold exactly
+        factor = saturation_factor(name, args)
+        if self.saturation is not None and not (0 <= factor <= 1 and 0 <= self.saturation <= 1):
+            self.flush()
+        self.saturation = factor if self.saturation is None else factor * self.saturation
+
+    def call(self, fn, *args, **kwargs):
+        self.img = fn(self.flush(), *args, **kwargs)
+
+    def run(self, ops):
+        for name, args, fn, kwargs in ops:
+            if name in _POINT_OPS:
+                self.point(name, args)
+            elif name in _MATRIX_OPS:
+                self.mat(name, args)
+            else:
+                self.call(fn, *args, **kwargs)
+        return self.flush()
+
+
+def _sample_jitter(jitter, ops):
+    fn_idx, b, c, s, h = jitter.get_params(jitter.brightness, jitter.contrast, jitter.saturation, jitter.hue)
+    for fn_id in fn_idx:
+        if fn_id == 0 and b is not None:
+            ops.append(('Brightness', (b,), None, None))
+        elif fn_id == 1 and c is not None:
+            ops.append(('Contrast', (c,), None, None))
+        elif fn_id == 2 and s is not None:
+            ops.append(('Color', (s,), None, None))
+        elif fn_id == 3 and h is not None:
+            ops.append(('Hue', (h,), F.adjust_hue, {}))
+
+
+def sample_color_ops(t, ops):
+    """Draw the random parameters of transform `t` and append its ops to `ops`, for `ColorPlan.run`."""
+    if isinstance(t, transforms.RandomApply):
+        if t.p < torch.rand(1):
+            return
+        for inner in t.transforms:
+            sample_color_ops(inner, ops)
+    elif isinstance(t, transforms.ColorJitter):
+        _sample_jitter(t, ops)
+    elif isinstance(t, transforms.RandomGrayscale):
+        if torch.rand(1) < t.p:
+            ops.append(('Grayscale', (), None, None))
+    elif isinstance(t, RandAugment):
+        for op in t.sample_ops():
+            level_args = op.sample()
+            if level_args is not None:
+                ops.append((op.name, level_args, op.aug_fn, op.kwargs))
+    elif isinstance(t, FusedColorTransform):
+        for inner in t.transforms:
+            sample_color_ops(inner, ops)
+    else:
+        ops.append((type(t).__name__, (), t, {}))
+
+
+class FusedColorTransform(object):
+    """Drop-in for a run of `RandomApply([ColorJitter])`, `ColorJitter`, `RandomGrayscale` and `RandAugment`"""
+
+    def __init__(self, transforms_list):
+        self.transforms = list(transforms_list)
+
+    def __call__(self, img):
+        ops = []
+        for t in self.transforms:
+            sample_color_ops(t, ops)
+        return ColorPlan(img).run(ops)
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, self.transforms)
+
+
+def _fusable(t):
+    if isinstance(t, transforms.RandomApply):
+        return all(_fusable(inner) for inner in t.transforms)
+    return isinstance(t, (transforms.ColorJitter, transforms.RandomGrayscale, RandAugment))
+
+
+def fuse_color_transforms(pipeline):
+    """Replace every run of colour transforms in an augmentation list by one `FusedColorTransform`."""
+    fused, run = [], []
+    for t in list(pipeline) + [None]:
+        if t is not None and _fusable(t):
+            run.append(t)
+            continue
+        if run:
+            fused.append(FusedColorTransform(run))
+            run = []
+        if t is not None:
+            fused.append(t)
+    return fused
@@ -0,0 +1,78 @@
+"""Mosaic-stitching collate for the rand-rand training views.
+
+`train` used to concatenate the eight contrastive views of a batch, shuffle them with a
+`randperm` and stitch them into two 2x2 mosaics with `torch.cat`, all in the main
+process. `MosaicCollate` does the same in the DataLoader workers: it draws the
+permutation first and copies every view straight into its quadrant of a preallocated
+mosaic batch, so the main process receives tensors ready for `BCLModel.forward(train=True)`.
+"""
+import torch
+from torch.utils.data import get_worker_info
+
+
+def _empty(shape, dtype):
+    # like default_collate: inside a worker, allocate in shared memory so the batch is not copied again
+    if get_worker_info() is None:
+        return torch.empty(shape, dtype=dtype)
+    numel = 1
+    for s in shape:
+        numel *= s
+    storage = torch.empty(0, dtype=dtype)._typed_storage()._new_shared(numel)
+    return torch.empty(0, dtype=dtype).new(storage).view(shape)
+
+
+def _view_labels(label, num_views):
+    if isinstance(label, (list, tuple)):
+        return [int(l) for l in label[1:]]
+    return [int(label)] * num_views
+
+
+class MosaicCollate(object):
+    """`collate_fn` turning `([cls_view] + views, label)` samples into
+    `(cls_images, mosaic1, mosaic2, cls_targets, view_targets)`.
+
+    View slot `s` of batch row `b` (mosaic `s // 4`, quadrant `s % 4` in row-major order)
+    holds the shuffled view `perm[s * B + b]`, and `view_targets` is ordered the same way,
+    exactly as the stitching in `train` did. `batch_augment` (e.g. the tensor RandAugment)
+    is applied to the classification batch and to every quadrant batch before stitching.
+    """
+
+    def __init__(self, grid=2, batch_augment=None):
+        self.grid = grid
+        self.batch_augment = batch_augment
+
+    def __call__(self, batch):
+        views, labels = zip(*batch)
+        bsz = len(batch)
+        num_views = len(views[0]) - 1
+        slots = self.grid * self.grid
+        num_mosaics = num_views // slots
+        assert num_views == num_mosaics * slots, '{} views do not tile {} mosaics'.format(num_views, slots)
+        c, h, w = views[0][1].shape
+        dtype = views[0][1].dtype
+
+        cls_images = torch.stack([v[0] for v in views], out=_empty((bsz,) + views[0][0].shape, views[0][0].dtype))
+        cls_targets = torch.tensor([l[0] if isinstance(l, (list, tuple)) else l for l in labels], dtype=torch.long)
+        view_labels = torch.tensor([_view_labels(l, num_views) for l in labels], dtype=torch.long)
+
+        # shuffled position k -> (view, sample), as images_gather[randperm] over the view-major concatenation
+        perm = torch.randperm(num_views * bsz)
+        src_view, src_sample = (perm // bsz + 1).tolist(), (perm % bsz).tolist()
+        view_targets = view_labels[perm % bsz, perm // bsz]
+
+        out_dtype = dtype if self.batch_augment is None else torch.float
+        mosaics = _empty((num_mosaics, bsz, c, self.grid * h, self.grid * w), out_dtype)
+        stitch = mosaics if self.batch_augment is None else torch.empty(mosaics.shape, dtype=dtype)
+        for s in range(num_views):
+            m, q = divmod(s, slots)
+            row, col = divmod(q, self.grid)
+            quadrant = stitch[m, :, :, row * h:(row + 1) * h, col * w:(col + 1) * w]
+            for b in range(bsz):
+                k = s * bsz + b
+                quadrant[b].copy_(views[src_sample[k]][src_view[k]])
+            if self.batch_augment is not None:
+                mosaics[m, :, :, row * h:(row + 1) * h, col * w:(col + 1) * w].copy_(self.batch_augment(quadrant))
+
+        if self.batch_augment is not None:
+            cls_images = self.batch_augment(cls_images)
+        return (cls_images,) + tuple(mosaics.unbind(0)) + (cls_targets, view_targets)
@@ -0,0 +1,21 @@
+def draft_scale(size, min_size):
+    """Largest JPEG DCT scale (1, 2, 4 or 8) that keeps the shorter side of `size` >= `min_size`."""
+    scale = 1
+    while scale < 8 and min(size) // (scale * 2) >= min_size:
+        scale *= 2
+    return scale
+
+
+def decode(img, min_size=None):
+    """Decode a lazily opened `img` to RGB.
+
+    With `min_size` set, JPEGs are decoded at reduced resolution in the DCT domain
+    (PIL draft mode) as long as the shorter side stays >= `min_size`; everything
+    else falls back to a full decode.
+    """
+    if min_size and img.format == 'JPEG':
+        scale = draft_scale(img.size, min_size)
+        if scale > 1:
+            w, h = img.size
+            img.draft('RGB', (w // scale, h // scale))
+    return img.convert('RGB')
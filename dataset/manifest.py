@@ -0,0 +1,119 @@
+"""Compact, shareable index of an `ImageNet_LT_*.txt` / `iNaturalist18_*.txt` manifest.
+
+A `Manifest` keeps the manifest in a handful of flat NumPy arrays instead of Python
+lists of strings and ints, so DataLoader workers share its pages instead of
+duplicating them through refcount copy-on-write:
+
+* `paths` / `path_offsets`: all relative paths in one uint8 buffer, path `i` is
+  `paths[path_offsets[i]:path_offsets[i + 1]]`;
+* `labels`: int32 label per sample;
+* `class_offsets` / `class_index`: CSR per-class sample lists, the samples of class `c`
+  are `class_index[class_offsets[c]:class_offsets[c + 1]]`.
+
+`Manifest.load` caches the arrays as `.npy` files next to the txt and memory-maps them
+on later runs.
+"""
+import os
+
+import numpy as np
+
+_FIELDS = ('paths', 'path_offsets', 'labels', 'class_offsets', 'class_index')
+
+
+def class_csr(labels, num_classes):
+    """(class_offsets, class_index) listing the samples of every class in index order."""
+    labels = np.asarray(labels)
+    class_index = np.argsort(labels, kind='stable').astype(np.int64)
+    class_offsets = np.zeros(num_classes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(labels, minlength=num_classes), out=class_offsets[1:])
+    return class_offsets, class_index
+
+
+def cache_prefix(txt):
+    return os.path.splitext(txt)[0]
+
+
+class Manifest(object):
+
+    def __init__(self, paths, path_offsets, labels, class_offsets, class_index, files=None):
+        self.paths = paths
+        self.path_offsets = path_offsets
+        self.labels = labels
+        self.class_offsets = class_offsets
+        self.class_index = class_index
+        # cache files the arrays are mapped from, if any
+        self.files = files
+
+    def __getstate__(self):
+        if self.files is None:
+            return self.__dict__
+        # spawned workers map the cache themselves instead of receiving a pickled copy
+        return {'files': self.files}
+
+    def __setstate__(self, state):
+        if list(state) == ['files']:
+            state = dict(zip(_FIELDS, [np.load(f, mmap_mode='r') for f in state['files']]), files=state['files'])
+        self.__dict__.update(state)
+
+    @classmethod
+    def parse(cls, txt, num_classes):
+        """Read `txt` (`<relative path> <label>` per line) once into flat arrays."""
+        paths, labels = [], []
+        with open(txt, 'rb') as f:
+            for line in f:
+                fields = line.split()
+                if fields:
+                    paths.append(fields[0])
+                    labels.append(int(fields[1]))
+        path_offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+        np.cumsum([len(p) for p in paths], out=path_offsets[1:])
+        labels = np.asarray(labels, dtype=np.int32)
+        return cls(np.frombuffer(b''.join(paths), dtype=np.uint8), path_offsets, labels,
+                   *class_csr(labels, num_classes))
+
+    @classmethod
+    def from_labels(cls, labels, num_classes):
+        """Label-only manifest, for datasets that locate samples some other way (e.g. packed shards)."""
+        labels = np.asarray(labels, dtype=np.int32)
+        return cls(None, None, labels, *class_csr(labels, num_classes))
+
+    @classmethod
+    def load(cls, txt, num_classes, cache=True):
+        """Memory-map the cached index of `txt`, (re)building it if missing or older than the txt."""
+        prefix = cache_prefix(txt)
+        files = ['{}.{}.npy'.format(prefix, field) for field in _FIELDS]
+        if cache and all(os.path.exists(f) and os.path.getmtime(f) >= os.path.getmtime(txt) for f in files):
+            manifest = cls(*[np.load(f, mmap_mode='r') for f in files], files=files)
+            if len(manifest.class_offsets) == num_classes + 1:
+                return manifest
+        manifest = cls.parse(txt, num_classes)
+        if cache and manifest.save(files):
+            manifest = cls(*[np.load(f, mmap_mode='r') for f in files], files=files)
+        return manifest
+
+    def save(self, files):
+        """Write the arrays to `files`, returns whether it succeeded."""
+        try:
+            for field, path in zip(_FIELDS, files):
+                # write-then-rename, other ranks may be loading the same cache
+                tmp = '{}.{}.tmp'.format(path, os.getpid())
+                with open(tmp, 'wb') as f:
+                    np.save(f, getattr(self, field))
+                os.replace(tmp, path)
+        except OSError as e:
+            print('=> could not cache manifest index: {}'.format(e))
+            return False
+        return True
+
+    def __len__(self):
+        return len(self.labels)
+
+    def path(self, i):
+        return self.paths[self.path_offsets[i]:self.path_offsets[i + 1]].tobytes().decode()
+
+    def class_indices(self, c):
+        return self.class_index[self.class_offsets[c]:self.class_offsets[c + 1]]
+
+    @property
+    def cls_num_list(self):
+        return np.diff(self.class_offsets).tolist()
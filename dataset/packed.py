@@ -0,0 +1,126 @@
+"""Packed image shards for ImageNet-LT / iNaturalist manifests.
+
+`pack_manifest` concatenates the raw (still encoded) image files listed in an
+`ImageNet_LT_*.txt` / `iNaturalist18_*.txt` manifest into a few large shard files
+plus an index of (shard, offset, length, label) records. `PackedImageNetLT` and
+`PackedINaturalist` serve samples from those shards through `mmap`, so the loader
+never opens or stats a per-image file.
+
+Usage:
+    python -m dataset.packed --root /path/to/imagenet --out /path/to/packed \
+        --txt dataset/ImageNet_LT/ImageNet_LT_train.txt dataset/ImageNet_LT/ImageNet_LT_val.txt
+"""
+import argparse
+import io
+import mmap
+import os
+
+import numpy as np
+
+from dataset.imagenet import ImageNetLT
+from dataset.inat import INaturalist
+from dataset.manifest import Manifest
+
+INDEX_DTYPE = np.dtype([('shard', '<i4'), ('offset', '<i8'), ('length', '<i8'), ('label', '<i4')])
+
+
+def shard_prefix(root, txt):
+    """Path prefix of the shards packed from manifest `txt` inside directory `root`."""
+    return os.path.join(root, os.path.splitext(os.path.basename(txt))[0])
+
+
+def pack_manifest(root, txt, out, shard_size=4 << 30):
+    """Pack every image listed in `txt` (relative to `root`) into shards under `out`."""
+    os.makedirs(out, exist_ok=True)
+    prefix = shard_prefix(out, txt)
+    with open(txt) as f:
+        lines = [line.split() for line in f if line.strip()]
+
+    index = np.empty(len(lines), dtype=INDEX_DTYPE)
+    shard, offset = 0, 0
+    dst = open('{}-{:05d}.bin'.format(prefix, shard), 'wb')
+    for i, (path, label) in enumerate(lines):
+        with open(os.path.join(root, path), 'rb') as src:
+            data = src.read()
+        if offset > 0 and offset + len(data) > shard_size:
+            dst.close()
+            shard, offset = shard + 1, 0
+            dst = open('{}-{:05d}.bin'.format(prefix, shard), 'wb')
+        dst.write(data)
+        index[i] = (shard, offset, len(data), int(label))
+        offset += len(data)
+        if i % 10000 == 0:
+            print('[{}/{}] {} -> shard {}'.format(i, len(lines), path, shard))
+    dst.close()
+
+    np.save(prefix + '.index.npy', index)
+    print('=> packed {} images from {} into {} shard(s) at {}'.format(len(lines), txt, shard + 1, prefix))
+    return prefix
+
+
+class PackedShards(object):
+    """Read-only view of the shards written by `pack_manifest`.
+
+    Shards are memory-mapped lazily and the maps are dropped on pickling, so every
+    DataLoader worker maps the files itself on first access.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.index = np.load(prefix + '.index.npy', mmap_mode='r')
+        self.num_shards = int(self.index['shard'].max()) + 1 if len(self.index) else 0
+        self._maps = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_maps'] = None
+        return state
+
+    def _shard(self, shard):
+        if self._maps is None:
+            self._maps = [None] * self.num_shards
+        if self._maps[shard] is None:
+            with open('{}-{:05d}.bin'.format(self.prefix, shard), 'rb') as f:
+                self._maps[shard] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._maps[shard]
+
+    @property
+    def labels(self):
+        return self.index['label']
+
+    def __getitem__(self, i):
+        shard, offset, length, _ = self.index[i]
+        return memoryview(self._shard(shard))[offset:offset + length]
+
+
+class _PackedMixin(object):
+    """Swaps the per-file index/open of a manifest dataset for packed shards."""
+
+    def _index(self, root, txt):
+        self.shards = PackedShards(shard_prefix(root, txt))
+        return Manifest.from_labels(self.shards.labels, self.num_classes)
+
+    def _open(self, index):
+        return io.BytesIO(self.shards[index])
+
+
+class PackedImageNetLT(_PackedMixin, ImageNetLT):
+    pass
+
+
+class PackedINaturalist(_PackedMixin, INaturalist):
+    pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack manifest images into mmap-able shards')
+    parser.add_argument('--root', required=True, metavar='DIR', help='dataset root the manifest paths are relative to')
+    parser.add_argument('--txt', required=True, nargs='+', help='manifest file(s) to pack')
+    parser.add_argument('--out', required=True, metavar='DIR', help='output directory for shards and index')
+    parser.add_argument('--shard_size', default=4, type=float, help='shard size in GiB')
+    args = parser.parse_args()
+    for txt in args.txt:
+        pack_manifest(args.root, txt, args.out, shard_size=int(args.shard_size * (1 << 30)))
@@ -0,0 +1,181 @@
+"""Seedable, resumable, rank-sharded batch samplers for long-tailed training.
+
+Every epoch's index schedule is drawn in one vectorized NumPy pass from the CSR
+per-class index of a `dataset.manifest.Manifest`, with a generator seeded by
+`(seed, epoch)`. All ranks draw the same schedule and take every `num_replicas`-th
+index starting at `rank`, so the shards are disjoint and equally long.
+
+* `InstanceBatchSampler`: a plain shuffle, every sample once per epoch;
+* `ClassBalancedBatchSampler`: a class uniformly at random, then an instance of it;
+* `SqrtBatchSampler`: class probability proportional to sqrt(class size);
+* `ProgressiveBatchSampler`: moves from instance- to class-balanced probabilities
+  linearly over `total_epochs`.
+
+Every batch also carries a seed derived from `(seed, epoch, rank, batch)`. Wrapped in
+`BatchSeededDataset`, a DataLoader worker reseeds Python, NumPy and torch from it before
+producing the batch, so its augmentations do not depend on which worker produced it or on how
+many batches that worker produced before. A run resumed mid-epoch then draws the same views.
+"""
+import math
+import random
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, Sampler, get_worker_info
+
+
+class SeededBatch(list):
+    """Indices of one batch, with the `seed` its augmentations draw from."""
+
+    def __init__(self, indices, seed):
+        super(SeededBatch, self).__init__(indices)
+        self.seed = seed
+
+
+class BatchSeededDataset(Dataset):
+    """Reseeds `random`, `np.random` and torch from each `SeededBatch` before loading it in a
+    DataLoader worker. The main process (`num_workers=0`) keeps its own RNG stream."""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        return self.dataset[index]
+
+    def __getitems__(self, indices):
+        seed = getattr(indices, 'seed', None)
+        if seed is not None and get_worker_info() is not None:
+            random.seed(seed)
+            np.random.seed(seed)
+            torch.manual_seed(seed)
+        return [self.dataset[i] for i in indices]
+
+
+class ClassAwareBatchSampler(Sampler):
+    """Base class: draws `class_probs(epoch)`-weighted classes, then a uniform instance of each."""
+
+    def __init__(self, manifest, batch_size, drop_last=False, seed=0, num_replicas=1, rank=0):
+        self.class_offsets = np.asarray(manifest.class_offsets)
+        self.class_index = manifest.class_index
+        self.class_counts = np.diff(self.class_offsets)
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.num_samples = int(math.ceil(len(self.class_index) / num_replicas))
+        self.epoch = 0
+        self.start_batch = 0
+
+    def class_probs(self, epoch):
+        raise NotImplementedError
+
+    def schedule(self, epoch):
+        """Indices of every rank for `epoch`, `num_replicas * num_samples` long."""
+        rng = np.random.default_rng([self.seed, epoch])
+        total = self.num_samples * self.num_replicas
+        classes = rng.choice(len(self.class_counts), size=total, p=self.class_probs(epoch))
+        offsets = (rng.random(total) * self.class_counts[classes]).astype(np.int64)
+        return np.asarray(self.class_index[self.class_offsets[classes] + offsets])
+
+    def set_epoch(self, epoch, start_batch=0):
+        """Select the epoch to iterate, skipping its first `start_batch` batches when resuming."""
+        self.epoch = epoch
+        self.start_batch = start_batch
+
+    def state_dict(self, batches_done=None):
+        """Position to resume from; `batches_done` is what the training loop has consumed this epoch."""
+        return {'seed': self.seed, 'epoch': self.epoch,
+                'start_batch': self.start_batch if batches_done is None else batches_done}
+
+    def load_state_dict(self, state):
+        self.seed = state['seed']
+        self.set_epoch(state['epoch'], state['start_batch'])
+
+    def batch_seed(self, batch):
+        return int(np.random.SeedSequence([self.seed, self.epoch, self.rank, batch]).generate_state(1)[0])
+
+    def __iter__(self):
+        indices = self.schedule(self.epoch)[self.rank::self.num_replicas].tolist()
+        start, self.start_batch = self.start_batch, 0
+        for b in range(start, len(self)):
+            yield SeededBatch(indices[b * self.batch_size:(b + 1) * self.batch_size], self.batch_seed(b))
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_samples // self.batch_size
+        return (self.num_samples + self.batch_size - 1) // self.batch_size
+
+
+class InstanceBatchSampler(ClassAwareBatchSampler):
+
+    def class_probs(self, epoch):
+        return self.class_counts / self.class_counts.sum()
+
+    def schedule(self, epoch):
+        # without replacement, padded by wrapping around like DistributedSampler
+        rng = np.random.default_rng([self.seed, epoch])
+        perm = rng.permutation(len(self.class_index))
+        total = self.num_samples * self.num_replicas
+        return np.resize(perm, total)
+
+
+class ClassBalancedBatchSampler(ClassAwareBatchSampler):
+
+    def class_probs(self, epoch):
+        present = (self.class_counts > 0).astype(np.float64)
+        return present / present.sum()
+
+
+class SqrtBatchSampler(ClassAwareBatchSampler):
+
+    def class_probs(self, epoch):
+        weights = np.sqrt(self.class_counts)
+        return weights / weights.sum()
+
+
+class ProgressiveBatchSampler(ClassAwareBatchSampler):
+
+    def __init__(self, manifest, batch_size, total_epochs, **kwargs):
+        super(ProgressiveBatchSampler, self).__init__(manifest, batch_size, **kwargs)
+        self.total_epochs = total_epochs
+
+    def class_probs(self, epoch):
+        t = min(1., epoch / max(1, self.total_epochs - 1))
+        instance = self.class_counts / self.class_counts.sum()
+        balanced = (self.class_counts > 0) / float((self.class_counts > 0).sum())
+        return (1 - t) * instance + t * balanced
+
+
+BATCH_SAMPLERS = {
+    'instance': InstanceBatchSampler,
+    'class': ClassBalancedBatchSampler,
+    'sqrt': SqrtBatchSampler,
+    'progressive': ProgressiveBatchSampler,
+}
+
+
+def build_batch_sampler(name, manifest, batch_size, total_epochs=None, **kwargs):
+    """Batch sampler `name` (see `BATCH_SAMPLERS`) over the samples of `manifest`."""
+    if name == 'progressive':
+        return ProgressiveBatchSampler(manifest, batch_size, total_epochs, **kwargs)
+    return BATCH_SAMPLERS[name](manifest, batch_size, **kwargs)
+
+
+class ShardedEvalSampler(Sampler):
+    """Every `num_replicas`-th index from `rank`, without the padding of `DistributedSampler`,
+    so metrics summed over ranks count every sample exactly once."""
+
+    def __init__(self, dataset, num_replicas=1, rank=0):
+        self.num_total = len(dataset)
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def __iter__(self):
+        return iter(range(self.rank, self.num_total, self.num_replicas))
+
+    def __len__(self):
+        return len(range(self.rank, self.num_total, self.num_replicas))
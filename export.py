@@ -0,0 +1,88 @@
+"""Export a trained `bcl_ckpt.pth.tar` for serving, with a CPU latency / throughput report.
+
+The contrastive heads are dropped, BatchNorm is folded into the convolutions and the
+`NormedLinear` weight is normalized and scaled once (`models.inference.InferenceModel`).
+The result is saved as a frozen TorchScript module and optionally as ONNX, both taking
+normalized (N, 3, size, size) float images and returning (N, num_classes) logits.
+
+    python export.py log/<store_name>/bcl_ckpt.best.pth.tar --out bcl.pt --onnx bcl.onnx
+"""
+import argparse
+import copy
+import inspect
+import time
+
+import numpy as np
+import torch
+
+from models.inference import InferenceModel, load_bcl_checkpoint
+
+parser = argparse.ArgumentParser(description='export BCLModel for inference')
+parser.add_argument('checkpoint', help='bcl_ckpt.pth.tar written by main.py')
+parser.add_argument('--arch', default=None, choices=['resnet50', 'resnext50'],
+                    help='encoder, if the checkpoint does not record it')
+parser.add_argument('--out', default='bcl.pt', help='TorchScript output')
+parser.add_argument('--onnx', default='', help='also export ONNX to this path')
+parser.add_argument('--size', default=224, type=int, help='input image size')
+parser.add_argument('--batch_sizes', default=[1, 8, 32], type=int, nargs='+', help='batch sizes to report')
+parser.add_argument('--iters', default=20, type=int, help='timed iterations per batch size')
+parser.add_argument('--threads', default=None, type=int, help='torch intra-op threads for the report')
+
+
+def benchmark(model, batch_size, size, iters):
+    """(median latency in ms, images per second) of `model` on random (batch_size, 3, size, size) input."""
+    x = torch.randn(batch_size, 3, size, size)
+    times = []
+    with torch.no_grad():
+        for i in range(iters + 2):
+            start = time.perf_counter()
+            model(x)
+            # the first calls run the TorchScript profiling / optimization passes
+            if i >= 2:
+                times.append(time.perf_counter() - start)
+    latency = float(np.median(times))
+    return latency * 1000, batch_size / latency
+
+
+def export_onnx(model, example, path):
+    kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        # the TorchScript-based exporter, newer torch defaults to torch.export (needs onnxscript)
+        kwargs['dynamo'] = False
+    torch.onnx.export(model, example, path, input_names=['images'], output_names=['logits'],
+                      dynamic_axes={'images': {0: 'batch'}, 'logits': {0: 'batch'}}, opset_version=17, **kwargs)
+
+
+def main():
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    model, checkpoint = load_bcl_checkpoint(args.checkpoint, args.arch)
+    reference = copy.deepcopy(model)
+    engine = InferenceModel(model).eval()
+    print("=> loaded '{}' (epoch {}), {} classes".format(
+        args.checkpoint, checkpoint.get('epoch'), engine.fc.weight.shape[0]))
+
+    example = torch.randn(2, 3, args.size, args.size)
+    with torch.no_grad():
+        scripted = torch.jit.freeze(torch.jit.trace(engine, example))
+        error = (scripted(example) - reference(example)).abs().max().item()
+    scripted.save(args.out)
+    print('=> saved TorchScript to {} (max |logit difference| {:.2e})'.format(args.out, error))
+
+    if args.onnx:
+        try:
+            export_onnx(engine, example, args.onnx)
+            print('=> saved ONNX to {}'.format(args.onnx))
+        except ImportError as e:
+            print('=> skipped ONNX export: {}'.format(e))
+
+    print('{:>6}{:>16}{:>12}{:>16}{:>12}'.format('batch', 'eager ms', 'img/s', 'exported ms', 'img/s'))
+    for batch_size in args.batch_sizes:
+        eager = benchmark(reference, batch_size, args.size, args.iters)
+        exported = benchmark(scripted, batch_size, args.size, args.iters)
+        print('{:>6}{:>16.2f}{:>12.1f}{:>16.2f}{:>12.1f}'.format(batch_size, *(eager + exported)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""Closed-loop load generator for `serve.py`: p50 / p99 latency vs. throughput.
+
+Every concurrency level runs that many clients, each sending its next `POST /predict` as soon
+as the previous one is answered, and reports the completed requests per second together with
+the latency percentiles.
+
+    python loadgen.py --url http://127.0.0.1:8000 --images dataset/ImageNet_LT/ImageNet_LT_val.txt --root /data
+    python loadgen.py --unix /tmp/cbts.sock --concurrency 1 4 16 64
+"""
+import argparse
+import http.client
+import io
+import os
+import socket
+import threading
+import time
+from urllib.parse import urlparse
+
+import numpy as np
+from PIL import Image
+
+parser = argparse.ArgumentParser(description='load generator for serve.py')
+parser.add_argument('--url', default='http://127.0.0.1:8000')
+parser.add_argument('--unix', default='', help='connect to this Unix socket instead of --url')
+parser.add_argument('--images', default='', help='manifest (<relative path> <label> per line) of images to send '
+                                                 '(default: random JPEGs)')
+parser.add_argument('--root', default='', help='directory the manifest paths are relative to')
+parser.add_argument('--num_images', default=64, type=int, help='images to load or generate')
+parser.add_argument('--concurrency', default=[1, 4, 16], type=int, nargs='+')
+parser.add_argument('--requests', default=200, type=int, help='requests per concurrency level')
+parser.add_argument('--topk', default=5, type=int)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path):
+        super(UnixHTTPConnection, self).__init__('localhost')
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+def load_images(args):
+    """Encoded request bodies: files from the manifest, or random JPEGs."""
+    if args.images:
+        with open(args.images) as f:
+            paths = [line.split()[0] for line in f if line.strip()][:args.num_images]
+        images = []
+        for path in paths:
+            with open(os.path.join(args.root, path), 'rb') as f:
+                images.append(f.read())
+        return images
+    rng = np.random.RandomState(0)
+    images = []
+    for _ in range(args.num_images):
+        buf = io.BytesIO()
+        Image.fromarray(rng.randint(0, 256, (375, 500, 3), dtype=np.uint8)).save(buf, 'JPEG', quality=90)
+        images.append(buf.getvalue())
+    return images
+
+
+def run_level(connect, images, concurrency, num_requests, topk):
+    """(requests per second, latencies in seconds) of `num_requests` split over `concurrency` clients."""
+    latencies, errors = [], []
+    counter = iter(range(num_requests))
+    lock = threading.Lock()
+
+    def client():
+        conn = connect()
+        while True:
+            with lock:
+                n = next(counter, None)
+            if n is None:
+                break
+            start = time.perf_counter()
+            conn.request('POST', '/predict?k={}'.format(topk), body=images[n % len(images)],
+                         headers={'Content-Type': 'application/octet-stream'})
+            response = conn.getresponse()
+            response.read()
+            elapsed = time.perf_counter() - start
+            with lock:
+                if response.status == 200:
+                    latencies.append(elapsed)
+                else:
+                    errors.append(response.status)
+        conn.close()
+
+    clients = [threading.Thread(target=client) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for t in clients:
+        t.start()
+    for t in clients:
+        t.join()
+    if errors:
+        print('=> {} failed requests (status {})'.format(len(errors), sorted(set(errors))))
+    return len(latencies) / (time.perf_counter() - start), np.asarray(latencies)
+
+
+def main():
+    args = parser.parse_args()
+    if args.unix:
+        def connect():
+            return UnixHTTPConnection(args.unix)
+    else:
+        url = urlparse(args.url)
+
+        def connect():
+            return http.client.HTTPConnection(url.hostname, url.port or 80)
+    images = load_images(args)
+
+    # one warm-up round so the first level does not pay for the model's first batches
+    run_level(connect, images, 1, 4, args.topk)
+    print('{:>12}{:>12}{:>12}{:>12}'.format('concurrency', 'req/s', 'p50 ms', 'p99 ms'))
+    for concurrency in args.concurrency:
+        throughput, latencies = run_level(connect, images, concurrency, args.requests, args.topk)
+        print('{:>12}{:>12.1f}{:>12.1f}{:>12.1f}'.format(
+            concurrency, throughput, np.percentile(latencies, 50) * 1000, np.percentile(latencies, 99) * 1000))
+
+
+if __name__ == '__main__':
+    main()
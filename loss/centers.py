@@ -0,0 +1,68 @@
+"""Class-center subsampling for BalSCL over large label spaces.
+
+Every step `BCLModel` projects all C rows of `fc.weight` through `head_fc1` / `head_fc2`
+and BalSCL contrasts every anchor with all C centers. `CenterSampler` keeps every class
+present in the batch (their centers are the positives and the class-averaged terms of
+the batch) and draws `num_negatives` of the absent classes uniformly. Each sampled
+negative stands for `num_absent / num_negatives` absent classes, which `BalSCL` folds into
+its class-averaging weights, so the denominator is an unbiased estimate of the full one.
+
+With `refresh_every` the negatives are read from a cache of all centers instead, rebuilt
+without gradient every `refresh_every` steps, and only the batch classes are projected. The
+cache keeps the BatchNorm statistics of the center heads over all centers as well; the batch
+classes are projected with them (`BCLModel.project_centers(classes, stats)`), so cached and
+fresh centers are normalized alike, as in the full projection at refresh time.
+"""
+import torch
+
+
+class CenterSampler(object):
+
+    def __init__(self, num_classes, num_negatives, refresh_every=0):
+        self.num_classes = num_classes
+        self.num_negatives = num_negatives
+        self.refresh_every = refresh_every
+        self.cache = None
+        self.stats = None
+        self.steps = 0
+
+    def state_dict(self):
+        return {'steps': self.steps, 'cache': self.cache, 'stats': self.stats}
+
+    def load_state_dict(self, state, device=None):
+        def to(obj):
+            if obj is None or isinstance(obj, torch.Tensor):
+                return obj if obj is None else obj.to(device)
+            return [to(o) for o in obj]
+        self.steps = state['steps']
+        self.cache = to(state['cache'])
+        self.stats = to(state.get('stats'))
+
+    def refresh(self, project_all):
+        """Rebuild the cache from `project_all()` ((all centers, BatchNorm statistics), see
+        `BCLModel.refresh_centers`) every `refresh_every` calls."""
+        if self.refresh_every and self.steps % self.refresh_every == 0:
+            with torch.no_grad():
+                centers, self.stats = project_all()
+                self.cache = [c.detach() for c in centers]
+        self.steps += 1
+
+    def sample(self, targets):
+        """(classes to project, center labels, center scale) of a step with view labels `targets`."""
+        present = torch.zeros(self.num_classes, dtype=torch.bool, device=targets.device)
+        present[targets] = True
+        classes = present.nonzero().view(-1)
+        absent = (~present).nonzero().view(-1)
+        negatives = absent[torch.randperm(len(absent), device=targets.device)[:self.num_negatives]]
+        labels = torch.cat([classes, negatives])
+        scale = torch.ones(len(labels), device=targets.device)
+        if len(negatives):
+            scale[len(classes):] = len(absent) / float(len(negatives))
+        return (classes if self.cache is not None else labels), labels, scale
+
+    def centers(self, projected, labels):
+        """Centers of `labels`: the projected ones, followed by the cached negatives if caching."""
+        if self.cache is None:
+            return projected
+        negatives = labels[projected[0].shape[0]:]
+        return [torch.cat([p, c[negatives].to(p.dtype)]) for p, c in zip(projected, self.cache)]
@@ -4,61 +4,175 @@ Date: May 07, 2020
 """
 from __future__ import print_function
 
+import math
+
 import torch
 import torch.nn as nn
 
 
+def _tile(feats, targets, weights, r0, r1, c0, c1, temperature):
+    """Logits, positive mask, self mask and log class-averaging weights of one (row, column) block."""
+    z = feats[r0:r1].mm(feats[c0:c1].T) / temperature
+    rows = torch.arange(r0, r1, device=feats.device).view(-1, 1)
+    cols = torch.arange(c0, c1, device=feats.device).view(1, -1)
+    self_mask = rows == cols
+    mask = (targets[r0:r1].view(-1, 1) == targets[c0:c1].view(1, -1)) & ~self_mask
+    # log(count[y_j] - mask_ij), the per-instance weight of the dense loss
+    log_w = torch.log(weights[c0:c1].view(1, -1) - mask.to(z.dtype))
+    return z, mask, self_mask, log_w
+
+
+class _TiledBalSCL(torch.autograd.Function):
+    """BalSCL over (row, column) blocks of the logits with an online log-sum-exp.
+
+    For anchor i, with positives m_ij and class-averaging weights w_ij,
+    loss_i = -sum_j m_ij z_ij / P_i + log sum_{j != i} exp(z_ij) / w_ij, which is the dense
+    loss with the row max cancelled. Backward recomputes every block instead of storing it.
+    """
+
+    @staticmethod
+    def forward(ctx, feats, targets, weights, num_anchors, temperature, row_block, col_block):
+        weights = weights.to(feats.dtype)
+        lse = feats.new_empty(num_anchors)
+        pos_sum = feats.new_zeros(num_anchors)
+        pos_cnt = feats.new_zeros(num_anchors)
+        lowest = torch.finfo(feats.dtype).min
+        for r0 in range(0, num_anchors, row_block):
+            r1 = min(num_anchors, r0 + row_block)
+            run_max = feats.new_full((r1 - r0,), lowest)
+            run_sum = feats.new_zeros(r1 - r0)
+            for c0 in range(0, feats.shape[0], col_block):
+                c1 = min(feats.shape[0], c0 + col_block)
+                z, mask, self_mask, log_w = _tile(feats, targets, weights, r0, r1, c0, c1, temperature)
+                pos_sum[r0:r1] += (z * mask).sum(1)
+                pos_cnt[r0:r1] += mask.sum(1)
+                a = (z - log_w).masked_fill(self_mask, lowest)
+                new_max = torch.maximum(run_max, a.max(1)[0])
+                run_sum = run_sum * torch.exp(run_max - new_max) + \
+                    (torch.exp(a - new_max.view(-1, 1)) * ~self_mask).sum(1)
+                run_max = new_max
+            lse[r0:r1] = run_max + torch.log(run_sum)
+        ctx.save_for_backward(feats, targets, weights, lse, pos_cnt)
+        ctx.temperature, ctx.row_block, ctx.col_block = temperature, row_block, col_block
+        return (lse - pos_sum / pos_cnt).mean()
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        feats, targets, weights, lse, pos_cnt = ctx.saved_tensors
+        num_anchors, temperature = lse.shape[0], ctx.temperature
+        scale = grad_output / (num_anchors * temperature)
+        grad = torch.zeros_like(feats)
+        for r0 in range(0, num_anchors, ctx.row_block):
+            r1 = min(num_anchors, r0 + ctx.row_block)
+            for c0 in range(0, feats.shape[0], ctx.col_block):
+                c1 = min(feats.shape[0], c0 + ctx.col_block)
+                z, mask, self_mask, log_w = _tile(feats, targets, weights, r0, r1, c0, c1, temperature)
+                # dloss/dz: softmax over the weighted columns minus the positive average
+                g = torch.exp(z - log_w - lse[r0:r1].view(-1, 1)) * ~self_mask - mask / pos_cnt[r0:r1].view(-1, 1)
+                g = g * scale
+                grad[r0:r1] += g.mm(feats[c0:c1])
+                grad[c0:c1] += g.T.mm(feats[r0:r1])
+        return grad, None, None, None, None, None, None
+
+
 class BalSCL(nn.Module):
-    def __init__(self, cls_num_list=None, temperature=0.1):
+    def __init__(self, cls_num_list=None, temperature=0.1, tile_budget=None):
         super(BalSCL, self).__init__()
         self.temperature = temperature
         self.cls_num_list = cls_num_list
+        # max logits per block for the tiled path, None keeps the dense one
+        self.tile_budget = tile_budget
 
-    def forward(self, centers1, features, targets, ):
+    def _column_weights(self, targets, device, center_labels=None, center_scale=None):
+        """Labels of all contrast columns (anchors, then centers) and their class counts in the batch.
 
-        device = (torch.device('cuda')
-                  if features.is_cuda
-                  else torch.device('cpu'))
-        batch_size = features.shape[0]    ##batch_size  128
-        targets = targets.contiguous().view(-1, 1)   ###torch.Size([128, 1])
-        targets_centers = torch.arange(len(self.cls_num_list), device=device).view(-1, 1)  #  
-        #print(targets.repeat(3, 1).shape)
-        # targets = torch.cat([targets.repeat(8, 1), targets_centers], dim=0)
-        targets = torch.cat([targets.repeat(1, 1), targets_centers], dim=0)
-        #targets = torch.cat([targets, targets_centers], dim=0)
-        batch_cls_count = torch.eye(len(self.cls_num_list))[targets].sum(dim=0).squeeze()
-
-        mask = torch.eq(targets[:8 * batch_size], targets.T).float().to(device)
+        `center_labels` are the classes of the given centers (default: all classes, in order).
+        A center standing in for `center_scale` unsampled ones counts as `1 / center_scale` of an
+        instance, so its exp term enters the class-averaged denominator `center_scale` times.
+        """
+        num_classes = len(self.cls_num_list)
+        if center_labels is None:
+            center_labels = torch.arange(num_classes, device=device)
+        targets = torch.cat([targets.contiguous().view(-1).to(device), center_labels.to(device)])
+        counts = torch.bincount(targets, minlength=num_classes)[targets].float()
+        if center_scale is not None:
+            num_anchors = targets.shape[0] - center_labels.shape[0]
+            counts[num_anchors:] = counts[num_anchors:] / center_scale.to(device)
+        return targets, counts
+
+    def forward_tiled(self, centers1, features, targets, center_labels=None, center_scale=None):
+        """Same loss as `forward`, computed in blocks of at most `tile_budget` logits."""
+        features = torch.cat(torch.unbind(features, dim=1), dim=0)
+        num_anchors = features.shape[0]
+        feats = torch.cat([features, centers1], dim=0)
+        targets, weights = self._column_weights(targets, feats.device, center_labels, center_scale)
+        row_block = min(num_anchors, max(1, int(math.sqrt(self.tile_budget))))
+        col_block = max(1, self.tile_budget // row_block)
+        return _TiledBalSCL.apply(feats, targets, weights, num_anchors, self.temperature, row_block, col_block)
+
+    def _pair_structures(self, targets, num_anchors, device, center_labels=None, center_scale=None):
+        """Positive mask, logits mask and class-averaging weights, shared by every (centers, features) pair."""
+        targets, column_count = self._column_weights(targets, device, center_labels, center_scale)
+        targets = targets.view(-1, 1)
+
+        mask = torch.eq(targets[:num_anchors], targets.T).float()
         logits_mask = torch.scatter(
             torch.ones_like(mask),
             1,
-            torch.arange(batch_size * 8).view(-1, 1).to(device),
+            torch.arange(num_anchors, device=device).view(-1, 1),
             0
         )
         mask = mask * logits_mask
-        
+        # count of each column's class, gathered on device
+        per_ins_weight = column_count.view(1, -1) - mask
+        return mask, logits_mask, per_ins_weight
+
+    def forward_pairs(self, centers, features, targets, pairs=None, reduction='sum', center_labels=None,
+                      center_scale=None):
+        """Loss for every `(i, j)` in `pairs`, pairing `centers[i]` with `features[j]` (default: all pairs).
+
+        The target structures are built once and all pairs run through one batched matmul.
+        Returns the summed loss, or the per-pair terms with `reduction='none'`. For a subset of
+        the class centers pass their classes as `center_labels`, and the number of classes each
+        one stands for as `center_scale` (see `_column_weights`).
+        """
+        if pairs is None:
+            pairs = [(i, j) for i in range(len(centers)) for j in range(len(features))]
+        # exp / log / 1 / temperature overflow or lose the positives in half precision:
+        # always compute in float32, also inside an autocast region
+        with torch.autocast(features[0].device.type, enabled=False):
+            centers = [c.to(torch.promote_types(c.dtype, torch.float32)) for c in centers]
+            features = [f.to(torch.promote_types(f.dtype, torch.float32)) for f in features]
+            if self.tile_budget:
+                losses = torch.stack([self.forward_tiled(centers[i], features[j], targets, center_labels, center_scale)
+                                      for i, j in pairs])
+            else:
+                losses = self._dense_pairs(centers, features, targets, pairs, center_labels, center_scale)
+        return losses.sum() if reduction == 'sum' else losses
+
+    def _dense_pairs(self, centers, features, targets, pairs, center_labels=None, center_scale=None):
         # class-complement
-        features = torch.cat(torch.unbind(features, dim=1), dim=0)
-        features = torch.cat([features, centers1], dim=0)
-        logits = features[:8 * batch_size].mm(features.T)
+        features = [torch.cat(torch.unbind(f, dim=1), dim=0) for f in features]
+        num_anchors = features[0].shape[0]
+        mask, logits_mask, per_ins_weight = self._pair_structures(targets, num_anchors, features[0].device,
+                                                                  center_labels, center_scale)
+        anchors = torch.stack([features[j] for _, j in pairs])
+        contrast = torch.cat([anchors, torch.stack([centers[i] for i, _ in pairs])], dim=1)
+        logits = torch.bmm(anchors, contrast.transpose(1, 2))
         logits = torch.div(logits, self.temperature)
 
         # For numerical stability
-        logits_max, _ = torch.max(logits, dim=1, keepdim=True)
+        logits_max, _ = torch.max(logits, dim=2, keepdim=True)
         logits = logits - logits_max.detach()
 
         # class-averaging
         exp_logits = torch.exp(logits) * logits_mask
-        per_ins_weight = torch.tensor([batch_cls_count[i] for i in targets], device=device).view(1, -1).expand(
-            8 * batch_size, 8 * batch_size + len(self.cls_num_list)) - mask
-        exp_logits_sum = exp_logits.div(per_ins_weight).sum(dim=1, keepdim=True)
-        
-        log_prob = logits - torch.log(exp_logits_sum)
-        mean_log_prob_pos = (mask * log_prob).sum(1) / mask.sum(1)
-
-        loss = - mean_log_prob_pos
-        loss = loss.view(8, batch_size).mean()
-        return loss
+        exp_logits_sum = exp_logits.div(per_ins_weight).sum(dim=2, keepdim=True)
 
+        log_prob = logits - torch.log(exp_logits_sum)
+        mean_log_prob_pos = (mask * log_prob).sum(2) / mask.sum(1)
 
+        return - mean_log_prob_pos.mean(1)
 
+    def forward(self, centers1, features, targets, ):
+        return self.forward_pairs([centers1], [features], targets)
@@ -9,12 +9,14 @@ class LogitAdjust(nn.Module):
 
     def __init__(self, cls_num_list, tau=1, weight=None):
         super(LogitAdjust, self).__init__()
-        cls_num_list = torch.cuda.FloatTensor(cls_num_list)
+        cls_num_list = torch.tensor(cls_num_list, dtype=torch.float)
         cls_p_list = cls_num_list / cls_num_list.sum()
         m_list = tau * torch.log(cls_p_list)
-        self.m_list = m_list.view(1, -1)
+        # a buffer, so it follows the criterion's .to(device)
+        self.register_buffer('m_list', m_list.view(1, -1))
         self.weight = weight
 
     def forward(self, x, target):
-        x_m = x + self.m_list
+        # log-priors of rare classes are large negatives, add them in float32 under autocast too
+        x_m = x.float() + self.m_list
         return F.cross_entropy(x_m, target, weight=self.weight)
@@ -1,15 +1,18 @@
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
 import time
-import shutil
 from torchvision.transforms import transforms
 from torch.utils.data import DataLoader
-import torch.nn.functional as F
 from loss.contrastive import BalSCL
+from loss.centers import CenterSampler
 from loss.logitadjust import LogitAdjust
 import math
+import numpy as np
 from tensorboardX import SummaryWriter
 from dataset.inat import INaturalist
 from dataset.imagenet import ImageNetLT
+from dataset.packed import PackedImageNetLT, PackedINaturalist
 # from models import resnet_big, resnext
 from models import resnext
 
@@ -19,16 +22,28 @@ from PIL import Image, ImageFilter, ImageOps
 import warnings
 import torch.backends.cudnn as cudnn
 import random
-from randaugment import rand_augment_transform
+from randaugment import rand_augment_transform, rand_augment_batch_transform
+from multiview import MultiViewTransform
+from dataset.collate import MosaicCollate
+from dataset.sampler import BATCH_SAMPLERS, BatchSeededDataset, ShardedEvalSampler, build_batch_sampler
+from affine import FusedAffineTransform
+from colorlut import fuse_color_transforms
 import torchvision
-from utils import GaussianBlur, shot_acc
+from checkpoint import CheckpointWriter, rng_state, set_rng_state
+from models.inference import strip_prefix
+from utils import GaussianBlur, ShotAccuracy, EvalAccumulator, VAL_DRAFT_SIZE, dataset_normalize, val_transform
 # from torch.models.tensorboard import SummaryWriter
 import argparse
 import os
+import signal
+import sys
+import threading
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--dataset', default='imagenet', choices=['inat', 'imagenet'])
 parser.add_argument('--data', default='/DATACENTER/raid5/zjg/imagenet', metavar='DIR')
+parser.add_argument('--packed', default='', type=str, metavar='DIR',
+                    help='read images from shards written by dataset/packed.py in DIR instead of --data')
 parser.add_argument('--arch', default='resnext50', choices=['resnet50', 'resnext50'])
 parser.add_argument('--workers', default=32, type=int)
 parser.add_argument('--epochs', default=90, type=int)
@@ -55,14 +70,47 @@ parser.add_argument('-e', '--evaluate', dest='evaluate', action='store_true',
                     help='evaluate model on validation set')
 parser.add_argument('--resume', default='', type=str, metavar='PATH',
                     help='path to latest checkpoint (default: none)')
+parser.add_argument('--ckpt_keep', default=0, type=int,
+                    help='keep per-epoch checkpoints of the last N epochs (0: only the latest and best)')
+parser.add_argument('--sync_ckpt', action='store_true',
+                    help='write checkpoints in the training loop instead of a background thread')
+parser.add_argument('--save_every_steps', default=0, type=int, metavar='N',
+                    help='also checkpoint every N training steps, to resume mid-epoch (0: only after each epoch)')
 parser.add_argument('--gpu', default=None, type=int,
                     help='GPU id to use.')
+parser.add_argument('--device', default=None, choices=['cuda', 'cpu'],
+                    help='device to train on (default: cuda if available)')
+parser.add_argument('--amp', default=None, choices=['fp16', 'bf16'],
+                    help='autocast mixed precision for the encoder, heads and losses (CPU supports bf16 only)')
+parser.add_argument('--world-size', default=-1, type=int,
+                    help='number of nodes for distributed training (default: 1 with --multiprocessing-distributed)')
+parser.add_argument('--rank', default=-1, type=int,
+                    help='node rank for distributed training (default: 0 with --multiprocessing-distributed)')
+parser.add_argument('--dist-url', default='tcp://127.0.0.1:23456', type=str,
+                    help='url used to set up distributed training')
+parser.add_argument('--dist-backend', default=None, type=str,
+                    help='distributed backend (default: nccl with GPUs, gloo without)')
+parser.add_argument('--multiprocessing-distributed', action='store_true',
+                    help='Use multi-processing distributed training to launch '
+                         'N processes per node, which has N GPUs. This is the '
+                         'fastest way to use PyTorch for either single node or '
+                         'multi node data parallel training')
+parser.add_argument('--nprocs', default=2, type=int,
+                    help='processes per node with --multiprocessing-distributed on a machine without GPUs')
 parser.add_argument('--alpha', default=1.0, type=float, help='cross entropy loss weight')
 parser.add_argument('--beta', default=0.5, type=float, help='supervised contrastive loss weight')
 parser.add_argument('--randaug', default=True, type=bool, help='use RandAugmentation for classification branch')
 parser.add_argument('--cl_views', default='sim-sim', type=str, choices=['sim-sim', 'sim-rand', 'rand-rand'],
                     help='Augmentation strategy for contrastive learning views')
+parser.add_argument('--multiview', action='store_true',
+                    help='decode each training image once and generate all rand-rand views in one pass')
+parser.add_argument('--jpeg_draft', action='store_true',
+                    help='decode JPEGs at reduced DCT scale when the outputs allow it (val, and train with --multiview)')
 parser.add_argument('--feat_dim', default=1024, type=int, help='feature dimension of mlp head')
+parser.add_argument('--grad_checkpoint', default='none', choices=['none', 'stage', 'block'],
+                    help='recompute encoder activations in backward instead of storing them, per stage or per block')
+parser.add_argument('--checkpoint_stages', default=[1, 2, 3, 4], type=int, nargs='+',
+                    help='encoder stages (layer1..layer4) to checkpoint with --grad_checkpoint')
 parser.add_argument('--warmup_epochs', default=0, type=int,
                     help='warmup epochs')
 parser.add_argument('--root_log', type=str, default='log')
@@ -72,6 +120,25 @@ parser.add_argument('--use_norm', default=True, type=bool,
                     help='cosine classifier.')
 parser.add_argument('--randaug_m', default=10, type=int, help='randaug-m')
 parser.add_argument('--randaug_n', default=2, type=int, help='randaug-n')
+parser.add_argument('--randaug_backend', default='pil', choices=['pil', 'tensor'],
+                    help='tensor runs RandAugment and normalization on the collated uint8 batch instead of per image')
+parser.add_argument('--fused_color', action='store_true',
+                    help='plan colour jitter, grayscale and RandAugment colour ops into fused LUT/matrix passes')
+parser.add_argument('--fused_affine', action='store_true',
+                    help='compose crop, flip and RandAugment geometric ops into one affine warp per view')
+parser.add_argument('--mosaic_collate', action='store_true',
+                    help='shuffle and stitch the rand-rand views into mosaics inside the loader workers')
+parser.add_argument('--scl_tile_budget', default=0, type=int,
+                    help='compute the contrastive loss in blocks of at most this many logits (0: dense)')
+parser.add_argument('--center_negatives', default=0, type=int,
+                    help='project only the batch classes plus this many sampled negative class centers (0: all)')
+parser.add_argument('--center_refresh', default=0, type=int,
+                    help='with --center_negatives, take the negatives from a cache of all centers '
+                         'refreshed every N steps (0: project them every step)')
+parser.add_argument('--eval_logits', default='', type=str, metavar='PATH',
+                    help='stream validation logits to this .npy memmap')
+parser.add_argument('--sampler', default='instance', choices=sorted(BATCH_SAMPLERS),
+                    help='batch sampler for the training set (default: instance, a plain shuffle)')
 parser.add_argument('--seed', default=None, type=int, help='seed for initializing training')
 parser.add_argument('--reload', default=False, type=bool, help='load supervised model')
 parser.add_argument('--num_classes', default=1000, type=int, help='num_classes')
@@ -84,6 +151,7 @@ def main():
 
     if args.seed is not None:
         random.seed(args.seed)
+        np.random.seed(args.seed)
         torch.manual_seed(args.seed)
         cudnn.deterministic = True
         warnings.warn('You have chosen to seed training. '
@@ -91,12 +159,90 @@ def main():
                       'which can slow down your training considerably! '
                       'You may see unexpected behavior when restarting '
                       'from checkpoints.')
+    # every rank shuffles with the same seed; resuming takes it from the checkpoint
+    args.sampler_seed = args.seed if args.seed is not None else random.SystemRandom().randrange(2 ** 31)
 
     if args.gpu is not None:
         warnings.warn('You have chosen a specific GPU. This will completely '
                       'disable data parallelism.')
-    ngpus_per_node = torch.cuda.device_count()
-    main_worker(args.gpu, ngpus_per_node, args)
+
+    if args.device is None:
+        args.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    if args.device == 'cpu' and args.amp == 'fp16':
+        parser.error('--amp fp16 needs a GPU, use --amp bf16 on CPU')
+
+    if args.dist_url == "env://" and args.world_size == -1:
+        args.world_size = int(os.environ["WORLD_SIZE"])
+    if args.multiprocessing_distributed and args.dist_url != "env://":
+        # a single node unless told otherwise, not -1 nodes and rank -1 * nprocs + local rank
+        if args.world_size == -1:
+            args.world_size = 1
+        if args.rank == -1:
+            args.rank = 0
+        if args.world_size < 1 or not 0 <= args.rank < args.world_size:
+            parser.error('--multiprocessing-distributed needs --world-size >= 1 and 0 <= --rank < --world-size')
+
+    args.distributed = args.world_size > 1 or args.multiprocessing_distributed
+    if args.dist_backend is None:
+        args.dist_backend = 'nccl' if args.device == 'cuda' else 'gloo'
+
+    ngpus_per_node = torch.cuda.device_count() if args.device == 'cuda' else 0
+    # without GPUs (gloo on CPU) spawn --nprocs processes per node instead
+    nprocs = ngpus_per_node or args.nprocs
+    if args.multiprocessing_distributed:
+        # Since we have ngpus_per_node processes per node, the total world_size
+        # needs to be adjusted accordingly
+        args.world_size = nprocs * args.world_size
+        # Use torch.multiprocessing.spawn to launch distributed processes: the
+        # main_worker process function; on SIGTERM wait for them to checkpoint and exit
+        signal.signal(signal.SIGTERM, request_stop)
+        mp.spawn(main_worker, nprocs=nprocs, args=(ngpus_per_node, args))
+    else:
+        # Simply call main_worker function
+        main_worker(args.gpu, ngpus_per_node, args)
+
+
+def is_main_process(args):
+    return not args.distributed or args.rank == 0
+
+
+# set by SIGTERM (preemption): checkpoint after the current step and exit
+stop_requested = threading.Event()
+
+
+def request_stop(signum, frame):
+    stop_requested.set()
+
+
+class StopAgreement(object):
+    """Whether any rank got SIGTERM, agreed on by all ranks so they stop at the same step.
+
+    Every call starts an asynchronous all-reduce of the local flag on a CPU (gloo) group and returns
+    the result of the previous call's, so the training step neither waits on a collective nor syncs
+    the device; a SIGTERM is acted on one call later. All ranks must call it equally often.
+    """
+
+    def __init__(self, args):
+        self.group = dist.new_group(backend='gloo') if args.distributed else None
+        self.pending = None
+
+    def __call__(self):
+        if self.group is None:
+            return stop_requested.is_set()
+        stop = False
+        if self.pending is not None:
+            work, flag = self.pending
+            work.wait()
+            stop = bool(flag.item())
+        flag = torch.tensor([float(stop_requested.is_set())])
+        self.pending = (dist.all_reduce(flag, op=dist.ReduceOp.MAX, group=self.group, async_op=True), flag)
+        return stop
+
+
+def autocast(args):
+    """Mixed-precision context of `--amp` on `args.device`, a no-op without it."""
+    dtype = torch.bfloat16 if args.amp == 'bf16' else torch.float16
+    return torch.autocast(device_type=args.device.type, dtype=dtype, enabled=args.amp is not None)
 
 class GaussianBlur(object):
     """Gaussian blur augmentation from SimCLR: https://arxiv.org/abs/2002.05709"""
@@ -117,44 +263,85 @@ class Solarize(object):
         return ImageOps.solarize(x)
 
 def main_worker(gpu, ngpus_per_node, args):
-    args.gpu = gpu
+    # spawned processes get their local index here, which is only a GPU id if there are GPUs
+    local_rank = gpu
+    args.gpu = gpu if ngpus_per_node else None
     if args.gpu is not None:
         print("Use GPU: {} for training".format(args.gpu))
 
+    if args.distributed:
+        if args.dist_url == "env://" and args.rank == -1:
+            args.rank = int(os.environ["RANK"])
+        if args.multiprocessing_distributed:
+            # For multiprocessing distributed training, rank needs to be the
+            # global rank among all the processes
+            args.rank = args.rank * (ngpus_per_node or args.nprocs) + local_rank
+        dist.init_process_group(backend=args.dist_backend, init_method=args.dist_url,
+                                world_size=args.world_size, rank=args.rank)
+    should_stop = StopAgreement(args)
+    args.device = torch.device('cuda', args.gpu) if args.gpu is not None else torch.device(args.device)
+
     # create model
     print("=> creating model '{}'".format(args.arch))
     if args.arch == 'resnet50':
         model = resnext.BCLModel(name='resnet50', num_classes=args.num_classes, feat_dim=args.feat_dim,
-                                 use_norm=args.use_norm)
+                                 use_norm=args.use_norm, checkpoint=args.grad_checkpoint,
+                                 checkpoint_stages=args.checkpoint_stages)
     elif args.arch == 'resnext50':
         model = resnext.BCLModel(name='resnext50', num_classes=args.num_classes, feat_dim=args.feat_dim,
-                                 use_norm=args.use_norm)
+                                 use_norm=args.use_norm, checkpoint=args.grad_checkpoint,
+                                 checkpoint_stages=args.checkpoint_stages)
     else:
         raise NotImplementedError('This model is not supported')
     print(model)
 
-    if args.gpu is not None:
+    if args.distributed:
+        if args.multiprocessing_distributed:
+            # When using a single device per process and per DistributedDataParallel,
+            # we need to divide the batch size ourselves based on the total number of processes
+            nprocs = ngpus_per_node or args.nprocs
+            args.batch_size = int(args.batch_size / nprocs)
+            args.workers = int((args.workers + nprocs - 1) / nprocs)
+        if args.gpu is not None:
+            torch.cuda.set_device(args.gpu)
+            model.cuda(args.gpu)
+            model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu])
+        else:
+            # all available GPUs, or the CPU with gloo
+            model.to(args.device)
+            model = torch.nn.parallel.DistributedDataParallel(model)
+    elif args.gpu is not None:
         torch.cuda.set_device(args.gpu)
         model = model.cuda(args.gpu)
-    else:
+    elif args.device.type == 'cuda':
         model = torch.nn.DataParallel(model).cuda()
 
     optimizer = torch.optim.SGD(model.parameters(), args.lr, momentum=args.momentum, weight_decay=args.weight_decay)
+    # fp16 gradients underflow without loss scaling, bf16 has the float32 exponent range
+    scaler = torch.amp.GradScaler(args.device.type, enabled=args.amp == 'fp16')
+
+    best_acc1 = 0.0
+    best_many, best_med, best_few = 0.0, 0.0, 0.0
 
     # optionally resume from a checkpoint
+    checkpoint = None
     if args.resume:
         if os.path.isfile(args.resume):
             print("=> loading checkpoint '{}'".format(args.resume))
-            checkpoint = torch.load(args.resume, map_location='cuda:0')
+            checkpoint = torch.load(args.resume, map_location='cpu')
             args.start_epoch = checkpoint['epoch']
             best_acc1 = checkpoint['best_acc1']
-            if args.gpu is not None:
-                # best_acc1 may be from a checkpoint from a different GPU
-                best_acc1 = best_acc1.to(args.gpu)
-            model.load_state_dict(checkpoint['state_dict'], strict=False)
-            #optimizer.load_state_dict(checkpoint['optimizer'])
-            print("=> loaded checkpoint '{}' (epoch {})"
-                  .format(args.resume, checkpoint['epoch']))
+            best_many, best_med, best_few = checkpoint.get('best_shots', (0.0, 0.0, 0.0))
+            # the same weights whether saved and resumed with or without a (D)DP wrapper; --reload
+            # evaluates supervised checkpoints, which may lack some of the heads
+            getattr(model, 'module', model).load_state_dict(strip_prefix(checkpoint['state_dict']),
+                                                            strict=not args.reload)
+            if not args.reload:
+                optimizer.load_state_dict(checkpoint['optimizer'])
+                if 'scaler' in checkpoint:
+                    scaler.load_state_dict(checkpoint['scaler'])
+            print("=> loaded checkpoint '{}' (epoch {}, step {})"
+                  .format(args.resume, checkpoint['epoch'], checkpoint.get('step', 0)))
         else:
             print("=> no checkpoint found at '{}'".format(args.resume))
 
@@ -165,20 +352,25 @@ def main_worker(gpu, ngpus_per_node, args):
     txt_val = f'dataset/ImageNet_LT/ImageNet_LT_val.txt' if args.dataset == 'imagenet' \
         else f'dataset/iNaturalist18/iNaturalist18_val.txt'
 
-    normalize = transforms.Normalize((0.466, 0.471, 0.380), (0.195, 0.194, 0.192)) if args.dataset == 'inat' \
-        else transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225))
+    normalize = dataset_normalize(args.dataset)
 
     rgb_mean = (0.485, 0.456, 0.406)
     ra_params = dict(translate_const=int(224 * 0.45), img_mean=tuple([min(255, round(255 * x)) for x in rgb_mean]), )
+    ra_config = 'rand-n{}-m{}-mstd0.5'.format(args.randaug_n, args.randaug_m)
+    if args.randaug_backend == 'tensor':
+        # the views stay uint8, RandAugment and normalize are applied to the whole batch in train()
+        randaug_tail = [transforms.PILToTensor()]
+        batch_augment = BatchAugment(rand_augment_batch_transform(ra_config, ra_params), normalize)
+    else:
+        randaug_tail = [rand_augment_transform(ra_config, ra_params), transforms.ToTensor(), normalize]
+        batch_augment = None
     augmentation_randncls = [
         transforms.RandomResizedCrop(224, scale=(0.08, 1.)),
         transforms.RandomHorizontalFlip(),
         transforms.RandomApply([
             transforms.ColorJitter(0.4, 0.4, 0.4, 0.0)
         ], p=1.0),
-        rand_augment_transform('rand-n{}-m{}-mstd0.5'.format(args.randaug_n, args.randaug_m), ra_params),
-        transforms.ToTensor(),
-        normalize,
+        *randaug_tail,
     ]
     augmentation_randnclsstack = [
         transforms.RandomResizedCrop(224),
@@ -187,9 +379,7 @@ def main_worker(gpu, ngpus_per_node, args):
             transforms.ColorJitter(0.4, 0.4, 0.4, 0.1)
         ], p=0.8),
         transforms.RandomGrayscale(p=0.2),
-        rand_augment_transform('rand-n{}-m{}-mstd0.5'.format(args.randaug_n, args.randaug_m), ra_params),
-        transforms.ToTensor(),
-        normalize,
+        *randaug_tail,
     ]
     augmentation_sim = [
         transforms.RandomResizedCrop(224),
@@ -211,100 +401,187 @@ def main_worker(gpu, ngpus_per_node, args):
         transforms.RandomGrayscale(p=0.2),
         #transforms.RandomApply([moco.loader.GaussianBlur([.1, 2.])], p=0.1),
         #transforms.RandomApply([moco.loader.Solarize()], p=0.2),
-        rand_augment_transform('rand-n{}-m{}-mstd0.5'.format(args.randaug_n, args.randaug_m), ra_params),
-        transforms.ToTensor(),
-        normalize,
+        *randaug_tail,
     ]
 
+    if args.fused_color:
+        augmentation_randncls = fuse_color_transforms(augmentation_randncls)
+        augmentation_randnclsstack = fuse_color_transforms(augmentation_randnclsstack)
+        augmentation_sim = fuse_color_transforms(augmentation_sim)
+        augmentation_randnclsstack_small = fuse_color_transforms(augmentation_randnclsstack_small)
+
+    compose = FusedAffineTransform if args.fused_affine else transforms.Compose
     if args.cl_views == 'sim-sim':
-        transform_train = [transforms.Compose(augmentation_randncls), transforms.Compose(augmentation_sim),
-                           transforms.Compose(augmentation_sim), ]
+        transform_train = [compose(augmentation_randncls), compose(augmentation_sim),
+                           compose(augmentation_sim), ]
     elif args.cl_views == 'sim-rand':
-        transform_train = [transforms.Compose(augmentation_randncls), transforms.Compose(augmentation_randnclsstack),
-                           transforms.Compose(augmentation_sim), ]
+        transform_train = [compose(augmentation_randncls), compose(augmentation_randnclsstack),
+                           compose(augmentation_sim), ]
     elif args.cl_views == 'rand-rand':
-        transform_train = [transforms.Compose(augmentation_randncls), transforms.Compose(augmentation_randnclsstack),
-                           transforms.Compose(augmentation_randnclsstack), transforms.Compose(augmentation_randnclsstack_small),]
+        if args.multiview:
+            transform_train = MultiViewTransform.from_pipelines(augmentation_randncls, augmentation_randnclsstack_small,
+                                                                draft=args.jpeg_draft, fused_affine=args.fused_affine)
+        else:
+            transform_train = [compose(augmentation_randncls), compose(augmentation_randnclsstack),
+                               compose(augmentation_randnclsstack), compose(augmentation_randnclsstack_small),]
     else:
         raise NotImplementedError("This augmentations strategy is not available for contrastive learning branch!")
 
-    val_transform = transforms.Compose([
-        transforms.Resize(256),
-        transforms.CenterCrop(224),
-        transforms.ToTensor(),
-        normalize
-    ])
+    eval_transform = val_transform(args.dataset)
 
-    val_dataset = INaturalist(
-        root=args.data,
-        txt=txt_val,
-        transform=val_transform, train=False,
-    ) if args.dataset == 'inat' else ImageNetLT(
-        root=args.data,
+    if args.packed:
+        dataset_cls = PackedINaturalist if args.dataset == 'inat' else PackedImageNetLT
+        data_root = args.packed
+    else:
+        dataset_cls = INaturalist if args.dataset == 'inat' else ImageNetLT
+        data_root = args.data
+
+    val_draft_size = VAL_DRAFT_SIZE if args.jpeg_draft else None
+
+    val_dataset = dataset_cls(
+        root=data_root,
         txt=txt_val,
-        transform=val_transform, train=False)
+        transform=eval_transform, train=False, draft_size=val_draft_size)
 
-    train_dataset = INaturalist(
-        root=args.data,
-        txt=txt_train,
-        transform=transform_train
-    ) if args.dataset == 'inat' else ImageNetLT(
-        root=args.data,
+    train_dataset = dataset_cls(
+        root=data_root,
         txt=txt_train,
         transform=transform_train)
 
     cls_num_list = train_dataset.cls_num_list
     args.cls_num = len(cls_num_list)
-
-    train_sampler = None
-
+    shot_accuracy = ShotAccuracy(cls_num_list)
+
+    collate_fn = None
+    if args.mosaic_collate:
+        # the quadrants get their RandAugment in the workers, before stitching
+        collate_fn, batch_augment = MosaicCollate(batch_augment=batch_augment), None
+
+    num_replicas, rank = (args.world_size, args.rank) if args.distributed else (1, 0)
+    # (seed, epoch, batch) fixes the shuffle and the workers' augmentation draws, so a step checkpoint
+    # can resume both at the exact batch
+    train_sampler = build_batch_sampler(args.sampler, train_dataset.manifest, args.batch_size,
+                                        total_epochs=args.epochs, seed=args.sampler_seed,
+                                        num_replicas=num_replicas, rank=rank)
     train_loader = torch.utils.data.DataLoader(
-        train_dataset, batch_size=args.batch_size, shuffle=(train_sampler is None),
-        num_workers=args.workers, pin_memory=True)
+        BatchSeededDataset(train_dataset), batch_sampler=train_sampler,
+        num_workers=args.workers, pin_memory=args.device.type == 'cuda', collate_fn=collate_fn)
 
+    # no padding, so the all-reduced counts cover every sample exactly once
+    val_sampler = ShardedEvalSampler(val_dataset, num_replicas, rank) if args.distributed else None
     val_loader = torch.utils.data.DataLoader(
         val_dataset, batch_size=args.batch_size, shuffle=False,
-        num_workers=args.workers, pin_memory=True)
-
-    criterion_ce = LogitAdjust(cls_num_list).cuda(args.gpu)
-    criterion_scl = BalSCL(cls_num_list, args.temp).cuda(args.gpu)
-
-    tf_writer = SummaryWriter(log_dir=os.path.join(args.root_log, args.store_name))
-
-    best_acc1 = 0.0
-    best_many, best_med, best_few = 0.0, 0.0, 0.0
+        num_workers=args.workers, pin_memory=args.device.type == 'cuda', sampler=val_sampler)
+
+    criterion_ce = LogitAdjust(cls_num_list).to(args.device)
+    criterion_scl = BalSCL(cls_num_list, args.temp, tile_budget=args.scl_tile_budget).to(args.device)
+    center_sampler = None
+    if args.center_negatives:
+        center_sampler = CenterSampler(args.cls_num, args.center_negatives, refresh_every=args.center_refresh)
+
+    resume = None
+    if checkpoint is not None:
+        if 'sampler' in checkpoint:
+            train_sampler.load_state_dict(checkpoint['sampler'])
+        if center_sampler is not None and 'center_sampler' in checkpoint:
+            center_sampler.load_state_dict(checkpoint['center_sampler'], args.device)
+        if 'rng' in checkpoint:
+            # one state per rank; fall back to rank 0's when resuming on a different world size
+            rng = checkpoint['rng']
+            resume = {'step': checkpoint.get('step', 0), 'meters': checkpoint.get('meters'),
+                      'rng': rng[rank] if rank < len(rng) else rng[0]}
+        del checkpoint
+
+    tf_writer = SummaryWriter(log_dir=os.path.join(args.root_log, args.store_name)) if is_main_process(args) else None
+    checkpoint_writer = None
+    if is_main_process(args):
+        checkpoint_writer = CheckpointWriter(os.path.join(args.root_log, args.store_name), keep=args.ckpt_keep,
+                                             background=not args.sync_ckpt)
+
+    def save_state(epoch, step=0, meters=None, is_best=False):
+        """Checkpoint everything needed to continue after `step` batches of `epoch`.
+
+        Collective when distributed (the RNG states of all ranks are gathered), so every rank calls it.
+        """
+        rng = [rng_state()]
+        if args.distributed:
+            rng = [None] * args.world_size
+            dist.all_gather_object(rng, rng_state())
+        if checkpoint_writer is None:
+            return
+        state = {
+            'epoch': epoch,
+            'step': step,
+            'arch': args.arch,
+            'state_dict': model.state_dict(),
+            'best_acc1': best_acc1,
+            'best_shots': (best_many, best_med, best_few),
+            'optimizer': optimizer.state_dict(),
+            'scaler': scaler.state_dict(),
+            'sampler': train_sampler.state_dict(step),
+            'rng': rng,
+            'cls_num_list': cls_num_list,
+        }
+        if meters is not None:
+            state['meters'] = {name: dict(meter.__dict__) for name, meter in meters.items()}
+        if center_sampler is not None:
+            state['center_sampler'] = center_sampler.state_dict()
+        # step checkpoints replace the latest one only, the retained per-epoch files stay epoch boundaries
+        checkpoint_writer.save(state, is_best, epoch=epoch if step == 0 else None)
+
+    def stop(epoch, step):
+        """Wait for the checkpoint just saved to be on disk and exit like the SIGTERM would have."""
+        if checkpoint_writer is not None:
+            checkpoint_writer.close()
+            print('=> SIGTERM: saved epoch {} step {} to {}, exiting'.format(epoch, step, checkpoint_writer.path))
+        if tf_writer is not None:
+            tf_writer.close()
+        sys.exit(128 + signal.SIGTERM)
+
+    def on_step(epoch, step, meters):
+        stopping = should_stop()
+        # the last step is covered by the checkpoint after validation
+        periodic = args.save_every_steps and step % args.save_every_steps == 0 and step < len(train_loader)
+        if stopping or periodic:
+            save_state(epoch, step, meters)
+        if stopping:
+            stop(epoch, step)
 
     if args.reload:
         txt_test = f'dataset/ImageNet_LT/ImageNet_LT_test.txt' if args.dataset == 'imagenet' \
             else f'dataset/iNaturalist18/iNaturalist18_val.txt'
-        test_dataset = INaturalist(
-            root=args.data,
-            txt=txt_test,
-            transform=val_transform, train=False
-        ) if args.dataset == 'inat' else ImageNetLT(
-            root=args.data,
+        test_dataset = dataset_cls(
+            root=data_root,
             txt=txt_test,
-            transform=val_transform, train=False)
+            transform=eval_transform, train=False, draft_size=val_draft_size)
 
+        test_sampler = ShardedEvalSampler(test_dataset, num_replicas, rank) if args.distributed else None
         test_loader = torch.utils.data.DataLoader(
             test_dataset, batch_size=args.batch_size, shuffle=False,
-            num_workers=args.workers, pin_memory=True)
-        acc1, many, med, few = validate(train_loader, test_loader, model, criterion_ce, 1, args, tf_writer)
+            num_workers=args.workers, pin_memory=args.device.type == 'cuda', sampler=test_sampler)
+        acc1, many, med, few = validate(test_loader, model, criterion_ce, shot_accuracy, 1, args, tf_writer)
         print('Prec@1: {:.3f}, Many Prec@1: {:.3f}, Med Prec@1: {:.3f}, Few Prec@1: {:.3f}'.format(acc1,
                                                                                                    many,
                                                                                                    med,
                                                                                                    few))
+        if tf_writer is not None:
+            tf_writer.close()
         return
 
+    # DataLoader workers are forked after this and inherit it, so a SIGTERM sent to the whole
+    # process group does not kill them before the checkpoint is written
+    signal.signal(signal.SIGTERM, request_stop)
     for epoch in range(args.start_epoch, args.epochs):
+        train_sampler.set_epoch(epoch, start_batch=resume['step'] if resume else 0)
         adjust_lr(optimizer, epoch, args)
 
         # train for one epoch
-        train(train_loader, model, criterion_ce, criterion_scl, optimizer, epoch, args, tf_writer)
+        train(train_loader, model, criterion_ce, criterion_scl, optimizer, scaler, epoch, args, tf_writer, batch_augment,
+              center_sampler, resume=resume, on_step=on_step)
+        resume = None
 
         # evaluate on validation set
-        acc1, many, med, few = validate(train_loader, val_loader, model, criterion_ce, epoch, args,
-                                        tf_writer)
+        acc1, many, med, few = validate(val_loader, model, criterion_ce, shot_accuracy, epoch, args, tf_writer)
         # remember best acc@1 and save checkpoint
         is_best = acc1 > best_acc1
         best_acc1 = max(acc1, best_acc1)
@@ -312,68 +589,110 @@ def main_worker(gpu, ngpus_per_node, args):
             best_many = many
             best_med = med
             best_few = few
-        print('Best Prec@1: {:.3f}, Many Prec@1: {:.3f}, Med Prec@1: {:.3f}, Few Prec@1: {:.3f}'.format(best_acc1,
-                                                                                                        best_many,
-                                                                                                        best_med,
-                                                                                                        best_few))
-        save_checkpoint(args, {
-            'epoch': epoch + 1,
-            'arch': args.arch,
-            'state_dict': model.state_dict(),
-            'best_acc1': best_acc1,
-            'optimizer': optimizer.state_dict(),
-        }, is_best)
-
-
-def train(train_loader, model, criterion_ce, criterion_scl, optimizer, epoch, args, tf_writer):
+        if is_main_process(args):
+            print('Best Prec@1: {:.3f}, Many Prec@1: {:.3f}, Med Prec@1: {:.3f}, Few Prec@1: {:.3f}'.format(
+                best_acc1, best_many, best_med, best_few))
+        save_state(epoch + 1, is_best=is_best)
+        if should_stop():
+            stop(epoch + 1, 0)
+    if tf_writer is not None:
+        tf_writer.close()
+    if checkpoint_writer is not None:
+        checkpoint_writer.close()
+
+
+def stitch_views(data, device, batch_augment=None):
+    """Shuffle the eight contrastive views of a default-collated batch and stitch them into two 2x2 mosaics"""
+    inputs, targets = data   #### input[0]:256,3,224,224
+    if batch_augment is not None:
+        inputs = [batch_augment(view) for view in inputs]
+    for_logit_targets = targets[0]
+    #print(inputs[1].shape)
+    images_gather = []
+    labels_gather = []
+    for ii in range(1, len(inputs)):
+        images_gather.append(inputs[ii])
+        #print(len(images_gather))
+    for iii in range(1, len(inputs)):
+        labels_gather.append(targets[iii])
+    batch_size = targets[0].shape[0]  #print('batch_size',batch_size) 256
+    permute = torch.randperm((len(inputs)-1) * batch_size)
+    images_gather = torch.cat(images_gather, dim=0)
+    images_gather = images_gather[permute, :, :, :]
+
+
+    labels_gather = torch.cat(labels_gather, dim=0)  #print("labels_gather",labels_gather)
+    labels_gather = labels_gather[permute]  #print(labels_gather)
+    targets = labels_gather
+
+
+    # stitched image1
+    col11 = torch.cat([images_gather[0:batch_size], images_gather[batch_size:2*batch_size]], dim=3)
+    col21 = torch.cat([images_gather[2*batch_size:3*batch_size], images_gather[3*batch_size:4*batch_size]], dim=3)
+    images_gather1 = torch.cat([col11, col21], dim=2)
+
+
+    # stitched image2
+    col12 = torch.cat([images_gather[4*batch_size:5*batch_size], images_gather[5*batch_size:6*batch_size]], dim=3)
+    col22 = torch.cat([images_gather[6*batch_size:7*batch_size], images_gather[7*batch_size:8*batch_size]], dim=3)
+    images_gather2 = torch.cat([col12, col22], dim=2)
+
+
+
+    inputs = torch.cat([inputs[0], images_gather1, images_gather2], dim=0)
+    inputs, targets = inputs.to(device), targets.to(device)
+    for_logit_targets = for_logit_targets.to(device)
+    return inputs, targets, for_logit_targets, batch_size
+
+
+def train(train_loader, model, criterion_ce, criterion_scl, optimizer, scaler, epoch, args, tf_writer,
+          batch_augment=None, center_sampler=None, resume=None, on_step=None):
+    """One epoch; `resume` ({'step', 'meters', 'rng'} of a step checkpoint) continues it after `step` batches
+    and `on_step(epoch, steps_done, meters)` runs after every optimizer step."""
     batch_time = AverageMeter('Time', ':6.3f')
     ce_loss_all = AverageMeter('CE_Loss', ':.4e')
     scl_loss_all = AverageMeter('SCL_Loss', ':.4e')
     top1 = AverageMeter('Acc@1', ':6.2f')
+    meters = {'batch_time': batch_time, 'ce_loss': ce_loss_all, 'scl_loss': scl_loss_all, 'top1': top1}
 
     model.train()
+    start_step = 0
+    if resume is not None:
+        start_step = resume['step']
+        for name, meter_state in (resume['meters'] or {}).items():
+            meters[name].__dict__.update(meter_state)
+    # creating the iterator draws the workers' base seed from torch's RNG: an epoch-boundary state
+    # was saved before that draw, a mid-epoch one after it
+    if resume is not None and start_step == 0:
+        set_rng_state(resume['rng'])
+    batches = iter(train_loader)
+    if resume is not None and start_step > 0:
+        set_rng_state(resume['rng'])
     end = time.time()
-    for i, data in enumerate(train_loader):
-        inputs, targets = data   #### input[0]:256,3,224,224       
-        for_logit_targets = targets[0]
-        #print(inputs[1].shape)
-        images_gather = []
-        labels_gather = []
-        for ii in range(1, len(inputs)):
-            images_gather.append(inputs[ii])
-            #print(len(images_gather))
-        for iii in range(1, len(inputs)):
-            labels_gather.append(targets[iii])
-        batch_size = targets[0].shape[0]  #print('batch_size',batch_size) 256
-        permute = torch.randperm((len(inputs)-1) * batch_size).cuda()
-        images_gather = torch.cat(images_gather, dim=0)
-        images_gather = images_gather[permute, :, :, :]
-
-
-        labels_gather = torch.cat(labels_gather, dim=0)  #print("labels_gather",labels_gather)
-        labels_gather = labels_gather[permute]  #print(labels_gather)
-        targets = labels_gather
-
-
-        # stitched image1
-        col11 = torch.cat([images_gather[0:batch_size], images_gather[batch_size:2*batch_size]], dim=3)
-        col21 = torch.cat([images_gather[2*batch_size:3*batch_size], images_gather[3*batch_size:4*batch_size]], dim=3)
-        images_gather1 = torch.cat([col11, col21], dim=2)
-
-
-        # stitched image2
-        col12 = torch.cat([images_gather[4*batch_size:5*batch_size], images_gather[5*batch_size:6*batch_size]], dim=3)
-        col22 = torch.cat([images_gather[6*batch_size:7*batch_size], images_gather[7*batch_size:8*batch_size]], dim=3)
-        images_gather2 = torch.cat([col12, col22], dim=2)
-
-
-
-        inputs = torch.cat([inputs[0], images_gather1, images_gather2], dim=0)
-        inputs, targets = inputs.cuda(), targets.cuda()
-        for_logit_targets = for_logit_targets.cuda()
-        feat_mlp1, feat_mlp2, logits, centers1, centers2 = model(inputs, train=True)
-        centers1 = centers1[:args.cls_num]
-        centers2 = centers2[:args.cls_num]
+    for i, data in enumerate(batches, start_step):
+        if args.mosaic_collate:
+            # views already shuffled and stitched by MosaicCollate
+            *images, for_logit_targets, targets = data
+            batch_size = for_logit_targets.shape[0]
+            inputs = torch.cat([x.to(args.device, non_blocking=True) for x in images], dim=0)
+            targets = targets.to(args.device, non_blocking=True)
+            for_logit_targets = for_logit_targets.to(args.device, non_blocking=True)
+        else:
+            inputs, targets, for_logit_targets, batch_size = stitch_views(data, args.device, batch_augment)
+        center_classes, center_labels, center_scale, center_stats = None, None, None, None
+        if center_sampler is not None:
+            with autocast(args):
+                center_sampler.refresh(getattr(model, 'module', model).refresh_centers)
+            center_classes, center_labels, center_scale = center_sampler.sample(targets)
+            center_stats = center_sampler.stats
+        with autocast(args):
+            feat_mlp1, feat_mlp2, logits, centers1, centers2 = model(inputs, train=True, center_classes=center_classes,
+                                                                     center_stats=center_stats)
+        if center_sampler is not None:
+            centers1, centers2 = center_sampler.centers([centers1, centers2], center_labels)
+        else:
+            centers1 = centers1[:args.cls_num]
+            centers2 = centers2[:args.cls_num]
         #print(centers.shape)
         f11, f12, f13, f14, g11, g12, g13, g14 = torch.split(feat_mlp1, [batch_size, batch_size, batch_size, batch_size, batch_size, batch_size, batch_size, batch_size], dim=0)
         f21, f22, f23, f24, g21, g22, g23, g24 = torch.split(feat_mlp2, [batch_size, batch_size, batch_size, batch_size, batch_size, batch_size, batch_size, batch_size], dim=0)
@@ -383,14 +702,13 @@ def train(train_loader, model, criterion_ce, criterion_scl, optimizer, epoch, ar
         logits = logits
         #scl_loss = criterion_scl(centers1, features2, targets)    ###为什么只有feature2能用
         #print('start calculate scl')
-        scl_loss1 = criterion_scl(centers1, features2, targets)
-        scl_loss2 = criterion_scl(centers2, features1, targets)
-        scl_loss3 = criterion_scl(centers1, features1, targets)
-        scl_loss4 = criterion_scl(centers2, features2, targets)
-        scl_loss = scl_loss1+scl_loss4+scl_loss2+scl_loss3
-        #print('complete calculate scl')
-        ce_loss = criterion_ce(logits, for_logit_targets)
-        loss = args.alpha * ce_loss + args.beta * scl_loss
+        # (centers1, features2), (centers2, features1), (centers1, features1), (centers2, features2) in one call
+        with autocast(args):
+            scl_loss = criterion_scl.forward_pairs([centers1, centers2], [features1, features2], targets,
+                                                   center_labels=center_labels, center_scale=center_scale)
+            #print('complete calculate scl')
+            ce_loss = criterion_ce(logits, for_logit_targets)
+            loss = args.alpha * ce_loss + args.beta * scl_loss
 
         ce_loss_all.update(ce_loss.item(), batch_size)
         scl_loss_all.update(scl_loss.item(), batch_size)
@@ -398,14 +716,14 @@ def train(train_loader, model, criterion_ce, criterion_scl, optimizer, epoch, ar
         top1.update(acc1[0].item(), batch_size)
 
         optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
 
         batch_time.update(time.time() - end)
-        end = time.time()
         #print(i)
 
-        if i % args.print_freq == 0:
+        if i % args.print_freq == 0 and is_main_process(args):
             output = ('Epoch: [{0}][{1}/{2}] \t'
                       'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
                       'CE_Loss {ce_loss.val:.4f} ({ce_loss.avg:.4f})\t'
@@ -414,62 +732,73 @@ def train(train_loader, model, criterion_ce, criterion_scl, optimizer, epoch, ar
                 epoch, i, len(train_loader), batch_time=batch_time,
                 ce_loss=ce_loss_all, scl_loss=scl_loss_all, top1=top1, ))  # TODO
             print(output)
-    tf_writer.add_scalar('CE loss/train', ce_loss_all.avg, epoch)
-    tf_writer.add_scalar('SCL loss/train', scl_loss_all.avg, epoch)
-    tf_writer.add_scalar('acc/train_top1', top1.avg, epoch)
+        if on_step is not None:
+            on_step(epoch, i + 1, meters)
+        end = time.time()
+    if tf_writer is not None:
+        tf_writer.add_scalar('CE loss/train', ce_loss_all.avg, epoch)
+        tf_writer.add_scalar('SCL loss/train', scl_loss_all.avg, epoch)
+        tf_writer.add_scalar('acc/train_top1', top1.avg, epoch)
 
     
 
-def validate(train_loader, val_loader, model, criterion_ce, epoch, args, tf_writer=None, flag='val'):
+def validate(val_loader, model, criterion_ce, shot_accuracy, epoch, args, tf_writer=None, flag='val'):
     model.eval()
     batch_time = AverageMeter('Time', ':6.3f')
     ce_loss_all = AverageMeter('CE_Loss', ':.4e')
     top1 = AverageMeter('Acc@1', ':6.2f')
-    total_logits = torch.empty((0, args.cls_num)).cuda()
-    total_labels = torch.empty(0, dtype=torch.long).cuda()
+    # running per-class counts on the device, read back once after the loop
+    logits_path = args.eval_logits or None
+    if logits_path and args.distributed:
+        logits_path = '{}.rank{}'.format(logits_path, args.rank)
+    evaluator = EvalAccumulator(args.cls_num, topk=(1,), logits_path=logits_path,
+                                num_samples=len(val_loader.sampler), device=args.device)
 
     with torch.no_grad():
         end = time.time()
         for i, data in enumerate(val_loader):
             inputs, targets = data
-            inputs, targets = inputs.cuda(), targets.cuda()
-            batch_size = targets.size(0)
-            logits = model(inputs)
-            ce_loss = criterion_ce(logits, targets)
-
-            total_logits = torch.cat((total_logits, logits))
-            total_labels = torch.cat((total_labels, targets))
-
-            acc1 = accuracy(logits, targets, topk=(1,))
-            ce_loss_all.update(ce_loss.item(), batch_size)
-            top1.update(acc1[0].item(), batch_size)
+            inputs, targets = inputs.to(args.device, non_blocking=True), targets.to(args.device, non_blocking=True)
+            with autocast(args):
+                logits = model(inputs)
+                ce_loss = criterion_ce(logits, targets)
+            evaluator.update(logits, targets, ce_loss)
 
             batch_time.update(time.time() - end)
 
-        if i % args.print_freq == 0:
-            output = ('Test: [{0}/{1}]\t'
-                      'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
-                      'CE_Loss {ce_loss.val:.4f} ({ce_loss.avg:.4f})\t'
-                      'Prec@1 {top1.val:.3f} ({top1.avg:.3f})'.format(
-                i, len(val_loader), batch_time=batch_time, ce_loss=ce_loss_all, top1=top1, ))  # TODO
+        results = evaluator.compute()
+        ce_loss_all.update(results['loss'], results['count'])
+        top1.update(results['top1'], results['count'])
+        output = ('Test: [{0}/{1}]\t'
+                  'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
+                  'CE_Loss {ce_loss.val:.4f} ({ce_loss.avg:.4f})\t'
+                  'Prec@1 {top1.val:.3f} ({top1.avg:.3f})'.format(
+            i, len(val_loader), batch_time=batch_time, ce_loss=ce_loss_all, top1=top1, ))  # TODO
+        if is_main_process(args):
             print(output)
 
-        tf_writer.add_scalar('CE loss/val', ce_loss_all.avg, epoch)
-        tf_writer.add_scalar('acc/val_top1', top1.avg, epoch)
+        if tf_writer is not None:
+            tf_writer.add_scalar('CE loss/val', ce_loss_all.avg, epoch)
+            tf_writer.add_scalar('acc/val_top1', top1.avg, epoch)
 
-        probs, preds = F.softmax(total_logits.detach(), dim=1).max(dim=1)
-        many_acc_top1, median_acc_top1, low_acc_top1 = shot_acc(preds, total_labels, train_loader,
-                                                                acc_per_cls=False)
+        many_acc_top1, median_acc_top1, low_acc_top1 = shot_accuracy.from_counts(results['class_correct'],
+                                                                                 results['class_total'])
         return top1.avg, many_acc_top1, median_acc_top1, low_acc_top1
 
 
 
 
-def save_checkpoint(args, state, is_best):
-    filename = os.path.join(args.root_log, args.store_name, 'bcl_ckpt.pth.tar')
-    torch.save(state, filename)
-    if is_best:
-        shutil.copyfile(filename, filename.replace('pth.tar', 'best.pth.tar'))
+class BatchAugment(object):
+    """RandAugment and normalize a collated uint8 view batch, for --randaug_backend tensor"""
+
+    def __init__(self, randaug, normalize):
+        self.randaug = randaug
+        self.mean = torch.tensor(normalize.mean).view(1, 3, 1, 1)
+        self.std = torch.tensor(normalize.std).view(1, 3, 1, 1)
+
+    def __call__(self, x):
+        x = self.randaug(x).float().div_(255)
+        return x.sub_(self.mean).div_(self.std)
 
 
 class TwoCropTransform:
@@ -0,0 +1,77 @@
+"""Inference-only `BCLModel`: encoder with BatchNorm folded into the convolutions, global average
+pooling and a classifier whose weight is normalized and scaled once, without the contrastive
+heads (`head1`, `head2`, `head_fc1`, `head_fc2`) that only the training forward uses.
+"""
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from models.resnext import BCLModel, BasicBlock, Bottleneck, NormedLinear
+
+
+def strip_prefix(state_dict, prefix='module.'):
+    """`state_dict` without the `prefix` DataParallel / DistributedDataParallel add to every key."""
+    return {k[len(prefix):] if k.startswith(prefix) else k: v for k, v in state_dict.items()}
+
+
+def load_bcl_checkpoint(path, arch=None):
+    """`BCLModel` in eval mode from a `bcl_ckpt.pth.tar`, with the classifier type and the number of
+    classes read off the checkpoint. Returns (model, checkpoint)."""
+    checkpoint = torch.load(path, map_location='cpu')
+    state_dict = strip_prefix(checkpoint['state_dict'])
+    use_norm = 'fc.bias' not in state_dict
+    # NormedLinear stores (in, out), nn.Linear (out, in)
+    num_classes = state_dict['fc.weight'].shape[1 if use_norm else 0]
+    model = BCLModel(num_classes=num_classes, name=arch or checkpoint.get('arch', 'resnet50'), use_norm=use_norm)
+    model.load_state_dict(state_dict)
+    return model.eval(), checkpoint
+
+
+def _fold(conv, bn):
+    return fuse_conv_bn_eval(conv, bn), nn.Identity()
+
+
+def fold_bn(encoder):
+    """Fold every BatchNorm2d of a `ResNet` into the convolution before it, in place."""
+    encoder.conv1, encoder.bn1 = _fold(encoder.conv1, encoder.bn1)
+    for layer in (encoder.layer1, encoder.layer2, encoder.layer3, encoder.layer4):
+        for block in layer:
+            block.conv1, block.bn1 = _fold(block.conv1, block.bn1)
+            block.conv2, block.bn2 = _fold(block.conv2, block.bn2)
+            if isinstance(block, Bottleneck):
+                block.conv3, block.bn3 = _fold(block.conv3, block.bn3)
+            else:
+                assert isinstance(block, BasicBlock)
+            if block.downsample is not None:
+                block.downsample = nn.Sequential(fuse_conv_bn_eval(block.downsample[0], block.downsample[1]))
+    return encoder
+
+
+class InferenceModel(nn.Module):
+    """`BCLModel.forward(train=False)` with BN folded and the classifier weight precomputed"""
+
+    def __init__(self, model):
+        super(InferenceModel, self).__init__()
+        model = model.eval()
+        self.encoder = fold_bn(model.encoder)
+        self.normalize = isinstance(model.fc, NormedLinear)
+        if self.normalize:
+            # s * normalize(x) @ normalize(W, dim=0) == s * normalize(x) @ W', with W' computed once
+            weight = model.fc.s * F.normalize(model.fc.weight.detach(), dim=0)
+            self.fc = nn.Linear(weight.shape[0], weight.shape[1], bias=False)
+            self.fc.weight.data.copy_(weight.T)
+        else:
+            self.fc = model.fc
+
+    def forward(self, x):
+        feat = torch.flatten(F.adaptive_avg_pool2d(self.encoder(x), 1), 1)
+        if self.normalize:
+            feat = F.normalize(feat, dim=1)
+        return self.fc(feat)
+
+
+def build_inference_model(path, arch=None):
+    """(InferenceModel, checkpoint) of a `bcl_ckpt.pth.tar`."""
+    model, checkpoint = load_bcl_checkpoint(path, arch)
+    return InferenceModel(model).eval(), checkpoint
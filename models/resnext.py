@@ -1,8 +1,11 @@
+import contextlib
+
 import torch
 from torch import Tensor
 import torch.nn as nn
-from typing import Type, Any, Callable, Union, List, Optional
+from typing import Type, Any, Callable, Union, List, Optional, Sequence
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 
 class NormedLinear(nn.Module):
@@ -18,6 +21,35 @@ class NormedLinear(nn.Module):
         return self.s * out
 
 
+@contextlib.contextmanager
+def _frozen_bn_stats(module: nn.Module):
+    """Restore the running stats of the BN layers of `module` on exit. The layers still run
+    exactly as before inside, so the recompute saves the same tensors as the first forward."""
+    buffers = [b for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)
+               for b in (m.running_mean, m.running_var, m.num_batches_tracked) if b is not None]
+    saved = [b.clone() for b in buffers]
+    try:
+        yield
+    finally:
+        with torch.no_grad():
+            for b, s in zip(buffers, saved):
+                b.copy_(s)
+
+
+def checkpoint_module(module: nn.Module, x: Tensor) -> Tensor:
+    """`module(x)` keeping only `x` for backward, which runs the module again. The recompute
+    uses the same batch statistics but must not update BN running stats a second time."""
+    calls = []
+
+    def run(inp: Tensor) -> Tensor:
+        if calls:
+            with _frozen_bn_stats(module):
+                return module(inp)
+        calls.append(None)
+        return module(inp)
+    return checkpoint(run, x, use_reentrant=False)
+
+
 def conv3x3(in_planes: int, out_planes: int, stride: int = 1, groups: int = 1, dilation: int = 1) -> nn.Conv2d:
     """3x3 convolution with padding"""
     return nn.Conv2d(in_planes, out_planes, kernel_size=3, stride=stride,
@@ -147,9 +179,16 @@ class ResNet(nn.Module):
             groups: int = 1,
             width_per_group: int = 64,
             replace_stride_with_dilation: Optional[List[bool]] = None,
-            norm_layer: Optional[Callable[..., nn.Module]] = None
+            norm_layer: Optional[Callable[..., nn.Module]] = None,
+            checkpoint: str = 'none',
+            checkpoint_stages: Sequence[int] = (1, 2, 3, 4)
     ) -> None:
         super(ResNet, self).__init__()
+        if checkpoint not in ('none', 'stage', 'block'):
+            raise ValueError("checkpoint should be 'none', 'stage' or 'block', got {}".format(checkpoint))
+        # activation checkpointing of layer1..layer4 while training: whole stages, or every block
+        self.checkpoint = checkpoint
+        self.checkpoint_stages = tuple(checkpoint_stages)
         if norm_layer is None:
             norm_layer = nn.BatchNorm2d
         self._norm_layer = norm_layer
@@ -229,11 +268,10 @@ class ResNet(nn.Module):
         x = self.relu(x)
         x = self.maxpool(x)
 
-        x = self.layer1(x)
-        x = self.layer2(x)
-        x = self.layer3(x)
-        x = self.layer4(x)
-        
+        x = self._forward_stage(1, self.layer1, x)
+        x = self._forward_stage(2, self.layer2, x)
+        x = self._forward_stage(3, self.layer3, x)
+        x = self._forward_stage(4, self.layer4, x)
 
         # x = self.avgpool(x)
         # x = torch.flatten(x, 1)
@@ -241,6 +279,16 @@ class ResNet(nn.Module):
 
         return x
 
+    def _forward_stage(self, index: int, layer: nn.Sequential, x: Tensor) -> Tensor:
+        if self.checkpoint == 'none' or index not in self.checkpoint_stages \
+                or not (self.training and torch.is_grad_enabled()):
+            return layer(x)
+        if self.checkpoint == 'stage':
+            return checkpoint_module(layer, x)
+        for block in layer:
+            x = checkpoint_module(block, x)
+        return x
+
     def forward(self, x: Tensor) -> Tensor:
         return self._forward_impl(x)
 
@@ -284,14 +332,49 @@ model_dict = {
 }
 
 
+def quadrant_pool_weights(size, upsample=(8, 8), grid=(2, 2)):
+    """(grid_h * grid_w, H * W) weights of bilinear upsampling to `upsample` followed by adaptive
+    average pooling to `grid`, so `weights @ x.flatten(-2)` are the row-major region descriptors."""
+    def axis(n, up, bins):
+        # 1-D linear interpolation of a unit impulse at every input position: (up, n)
+        interp = F.interpolate(torch.eye(n, dtype=torch.float64).unsqueeze(1), size=up,
+                               mode='linear', align_corners=False).squeeze(1).T
+        pool = F.adaptive_avg_pool1d(torch.eye(up, dtype=torch.float64).unsqueeze(1), bins).squeeze(1).T
+        return pool.mm(interp)
+    # bilinear resize and average pooling are separable
+    weights = torch.kron(axis(size[0], upsample[0], grid[0]), axis(size[1], upsample[1], grid[1]))
+    return weights.float()
+
+
+def _head_forward(head, x, stats=None):
+    """Run the MLP `head` with its BatchNorm1d layers normalizing by the given per-layer (mean, var)
+    `stats`, or by the statistics of `x` when None; the running buffers are never updated.
+    Returns the output and the statistics used."""
+    used = []
+    for layer in head:
+        if isinstance(layer, nn.BatchNorm1d):
+            if stats is None:
+                # float32 like the BatchNorm parameters, also when autocast runs the linears in half precision
+                x32 = x.float()
+                mean, var = x32.mean(0), x32.var(0, unbiased=False)
+            else:
+                mean, var = stats[len(used)]
+            used.append((mean.detach(), var.detach()))
+            x = F.batch_norm(x, mean, var, layer.weight, layer.bias, False, 0., layer.eps)
+        else:
+            x = layer(x)
+    return x, used
+
 
 class BCLModel(nn.Module):
-    def __init__(self, num_classes=1000, name='resnet50', head='mlp', use_norm=True, feat_dim=1024):
+    def __init__(self, num_classes=1000, name='resnet50', head='mlp', use_norm=True, feat_dim=1024,
+                 checkpoint='none', checkpoint_stages=(1, 2, 3, 4)):
         super(BCLModel, self).__init__()
         model_fun, dim_in = model_dict[name]
-        self.encoder = model_fun()
+        self.encoder = model_fun(checkpoint=checkpoint, checkpoint_stages=checkpoint_stages)
         self.avgpool = nn.AdaptiveAvgPool2d((1,1))
-        self.pgap = nn.AdaptiveAvgPool2d((2, 2))
+        # 7x7 -> 8x8 bilinear -> 2x2 average pool of a 224 px mosaic, as one (4, 49) matrix
+        self.register_buffer('quadrant_weights', quadrant_pool_weights((7, 7)), persistent=False)
         if head == 'mlp':
             self.head1 = nn.Sequential(nn.Linear(dim_in, 4096), nn.BatchNorm1d(4096), nn.ReLU(inplace=True), nn.Linear(4096, 256))
             self.head2 = nn.Sequential(nn.BatchNorm1d(256, affine=False),nn.Linear(256, 4096),nn.BatchNorm1d(4096), nn.ReLU(inplace=True),nn.Linear(4096, 256))
@@ -308,26 +391,52 @@ class BCLModel(nn.Module):
         self.head_fc2 = nn.Sequential(nn.BatchNorm1d(256, affine=False), nn.Linear(256, 4096),nn.BatchNorm1d(4096), nn.ReLU(inplace=True),nn.Linear(4096, 256))
         #self.head_fc = nn.Sequential(nn.Linear(dim_in, dim_in), nn.BatchNorm1d(dim_in), nn.ReLU(inplace=True), nn.Linear(dim_in, feat_dim))
 
-    def forward(self, x, train=False):
+    def quadrant_pool(self, mosaics, batch_size):
+        """(num_mosaics * 4 * B, C) quadrant descriptors of (num_mosaics * B, C, H, W) mosaic features,
+        ordered (mosaic, quadrant, sample) like the stitched views: [f1, f2, f3, f4, g1, g2, g3, g4]."""
+        num_mosaics = mosaics.shape[0] // batch_size
+        channels = mosaics.shape[1]
+        weights = self.quadrant_weights
+        if mosaics.shape[-2:] != (7, 7):
+            weights = quadrant_pool_weights(mosaics.shape[-2:]).to(weights.device)
+        # (4, HW) @ (num_mosaics, 1, HW, B*C): one matmul whose output is already in row order
+        x = mosaics.reshape(num_mosaics, 1, batch_size * channels, -1).transpose(-1, -2)
+        out = torch.matmul(weights.to(x.dtype), x)
+        return out.view(-1, channels)
+
+    def project_centers(self, classes=None, stats=None):
+        """Contrastive centers of `classes` (default: all) through head_fc1 / head_fc2.
+
+        With `stats` (from `refresh_centers`) the heads' BatchNorm layers normalize by those
+        statistics of all centers instead of the statistics of the projected rows."""
+        weight = self.fc.weight.T
+        if classes is not None:
+            weight = weight[classes]
+        if stats is not None:
+            centers_logits1_, _ = _head_forward(self.head_fc1, weight, stats[0])
+            centers_logits1 = F.normalize(centers_logits1_, dim=1)
+            centers_logits2 = F.normalize(_head_forward(self.head_fc2, centers_logits1_, stats[1])[0], dim=1)
+            return centers_logits1, centers_logits2
+        #centers_logits = F.normalize(self.head_fc(self.fc.weight.T), dim=1)
+        centers_logits1_ = self.head_fc1(weight)
+        centers_logits1 = F.normalize(centers_logits1_, dim=1)
+        centers_logits2 = F.normalize(self.head_fc2(centers_logits1_), dim=1)
+        return centers_logits1, centers_logits2
+
+    def refresh_centers(self):
+        """(all centers, BatchNorm statistics they were normalized by) for `loss.centers.CenterSampler`,
+        computed like the training-mode projection but without updating the running buffers."""
+        centers_logits1_, stats1 = _head_forward(self.head_fc1, self.fc.weight.T)
+        centers_logits2_, stats2 = _head_forward(self.head_fc2, centers_logits1_)
+        centers = F.normalize(centers_logits1_, dim=1), F.normalize(centers_logits2_, dim=1)
+        return centers, (stats1, stats2)
+
+    def forward(self, x, train=False, center_classes=None, center_stats=None):
         feat = self.encoder(x)  #B,C,7*7
         if train is True:
-            cls_, con1_, con2_ = torch.split(feat, [feat.shape[0]//3, feat.shape[0]//3, feat.shape[0]//3], dim=0)
-            # stitched image1
-            con_feat1 = F.interpolate(con1_, size=(8,8), mode='bilinear', align_corners=False)  #B,C,8*8
-            con_feat1 = self.pgap(con_feat1)#B,C,2*2
-            c1,c2 = con_feat1.split([1,1],dim=2)
-            f1,f2 = c1.split([1,1],dim=3)
-            f3,f4 = c2.split([1,1],dim=3)
-            # stitched image2
-            con_feat2 = F.interpolate(con2_, size=(8,8), mode='bilinear', align_corners=False)  #B,C,8*8
-            con_feat2 = self.pgap(con_feat2)#B,C,2*2
-            d1,d2 = con_feat2.split([1,1],dim=2)
-            g1,g2 = d1.split([1,1],dim=3)
-            g3,g4 = d2.split([1,1],dim=3)
-
-
-            con_gather = torch.cat([f1,f2,f3,f4,g1,g2,g3,g4],dim=0)  #torch.Size([512, 2048, 1, 1])
-            con_gather = con_gather.view(f1.shape[0]*8,-1)  #con_gather torch.Size([512, 2048])
+            batch_size = feat.shape[0] // 3
+            cls_ = feat[:batch_size]
+            con_gather = self.quadrant_pool(feat[batch_size:], batch_size)  #torch.Size([512, 2048])
             #feat_mlp = F.normalize(self.head(con_gather), dim=1)
             feat_mlp1_ = self.head1(con_gather)
             feat_mlp1 = F.normalize(feat_mlp1_, dim=1)
@@ -336,10 +445,8 @@ class BCLModel(nn.Module):
             logits = self.avgpool(cls_)
             logits = torch.flatten(logits, 1)
             logits = self.fc(logits)
-            #centers_logits = F.normalize(self.head_fc(self.fc.weight.T), dim=1)
-            centers_logits1_ = self.head_fc1(self.fc.weight.T)
-            centers_logits1 = F.normalize(centers_logits1_, dim=1)
-            centers_logits2 = F.normalize(self.head_fc2(centers_logits1_), dim=1)
+            # only the centers of `center_classes` when subsampling them (loss.centers.CenterSampler)
+            centers_logits1, centers_logits2 = self.project_centers(center_classes, center_stats)
 
             return feat_mlp1, feat_mlp2, logits, centers_logits1, centers_logits2
   
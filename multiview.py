@@ -0,0 +1,129 @@
+"""Decode-once multi-view generation for the training datasets.
+
+`MultiViewTransform` replaces the nine independent pipelines run by
+`ImageNetLT.__getitem__` / `INaturalist.__getitem__` (one 224px classification view
+and eight 112px contrastive views) with a single pass over one decoded image:
+
+* the classification view is cropped straight from the decoded image,
+* the source is then box-downsampled once, and every contrastive view is cropped
+  from that small copy instead of from the full-resolution image,
+* all views are normalized directly into one preallocated buffer.
+
+The transform receives the lazily opened image and decodes it itself: with `draft`
+set it samples the classification crop first and picks the coarsest JPEG DCT scale
+that still leaves that crop >= `cls_size` px and the shorter side >= `source_size`.
+"""
+import numpy as np
+import torch
+from PIL import Image
+from torchvision.transforms import transforms
+
+from affine import FusedAffineTransform
+from dataset.decode import decode
+
+
+class MultiViewTransform(object):
+    """Produce `[cls_view] + views` for one image, like `[transform[0](x)] + [transform[3](x)] * 8`.
+
+    `cls_transform` / `view_transform` are the PIL steps that follow the crop
+    (flip, colour jitter, RandAugment, ...); cropping, `ToTensor` and `Normalize`
+    are done here. Use `from_pipelines` to build it from the augmentation lists in main.py.
+    With `fused_affine` the transforms are `FusedAffineTransform`s and take the crop themselves.
+    """
+    # the datasets hand over the undecoded image, see `draft`
+    decodes = True
+
+    def __init__(self, cls_transform, view_transform, mean, std, num_views=8, cls_size=224, view_size=112,
+                 cls_scale=(0.08, 1.), view_scale=(0.08, 1.), cls_ratio=(3. / 4., 4. / 3.),
+                 view_ratio=(3. / 4., 4. / 3.), source_size=None, draft=False, fused_affine=False):
+        self.cls_transform = cls_transform
+        self.view_transform = view_transform
+        self.num_views = num_views
+        self.cls_size = cls_size
+        self.view_size = view_size
+        self.cls_scale = cls_scale
+        self.view_scale = view_scale
+        self.cls_ratio = cls_ratio
+        self.view_ratio = view_ratio
+        # shorter side the contrastive views are cropped from
+        self.source_size = source_size or 2 * view_size
+        self.draft = draft
+        self.fused_affine = fused_affine
+        # without mean/std the views stay uint8
+        self.normalize = mean is not None
+        if self.normalize:
+            self.mean = torch.tensor(mean).view(3, 1, 1) * 255
+            self.std = torch.tensor(std).view(3, 1, 1) * 255
+
+    @classmethod
+    def from_pipelines(cls, cls_pipeline, view_pipeline, num_views=8, fused_affine=False, **kwargs):
+        """Build from `[RandomResizedCrop, ..., ToTensor, Normalize]` augmentation lists.
+
+        Lists ending in `PILToTensor` instead give uint8 views, for the batched tensor RandAugment.
+        `fused_affine` warps every view once, see `affine.FusedAffineTransform`.
+        """
+        cls_crop, view_crop = cls_pipeline[0], view_pipeline[0]
+        assert isinstance(cls_crop, transforms.RandomResizedCrop)
+        assert isinstance(view_crop, transforms.RandomResizedCrop)
+        if isinstance(cls_pipeline[-1], transforms.PILToTensor):
+            mean, std, tail = None, None, 1
+        else:
+            assert isinstance(cls_pipeline[-2], transforms.ToTensor)
+            assert isinstance(cls_pipeline[-1], transforms.Normalize)
+            mean, std, tail = cls_pipeline[-1].mean, cls_pipeline[-1].std, 2
+        if fused_affine:
+            cls_transform, view_transform = FusedAffineTransform(cls_pipeline[:-tail]), \
+                FusedAffineTransform(view_pipeline[:-tail])
+        else:
+            cls_transform, view_transform = transforms.Compose(cls_pipeline[1:-tail]), \
+                transforms.Compose(view_pipeline[1:-tail])
+        return cls(cls_transform, view_transform, mean, std, num_views=num_views, fused_affine=fused_affine,
+                   cls_size=cls_crop.size[0], view_size=view_crop.size[0],
+                   cls_scale=cls_crop.scale, view_scale=view_crop.scale,
+                   cls_ratio=cls_crop.ratio, view_ratio=view_crop.ratio, **kwargs)
+
+    def _crop(self, img, size, scale, ratio, params=None):
+        i, j, h, w = params or transforms.RandomResizedCrop.get_params(img, scale, ratio)
+        return img.resize((size, size), Image.BILINEAR, box=(j, i, j + w, i + h))
+
+    def _decode(self, img):
+        """Decode `img` and return it with the classification crop in decoded coordinates."""
+        i, j, h, w = transforms.RandomResizedCrop.get_params(img, self.cls_scale, self.cls_ratio)
+        min_size = None
+        if self.draft:
+            min_size = max(self.source_size, -(-min(img.size) * self.cls_size // min(w, h)))
+        full_w, full_h = img.size
+        img = decode(img, min_size)
+        sx, sy = img.size[0] / full_w, img.size[1] / full_h
+        return img, (i * sy, j * sx, h * sy, w * sx)
+
+    def _downsample(self, img):
+        factor = min(img.size) // self.source_size
+        return img.reduce(factor) if factor >= 2 else img
+
+    def _write(self, out, img):
+        out.copy_(torch.from_numpy(np.array(img, dtype=np.uint8)).permute(2, 0, 1))
+        if self.normalize:
+            out.sub_(self.mean).div_(self.std)
+
+    def __call__(self, img):
+        cls_numel = 3 * self.cls_size * self.cls_size
+        buf = torch.empty(cls_numel + self.num_views * 3 * self.view_size * self.view_size,
+                          dtype=torch.float if self.normalize else torch.uint8)
+        cls_view = buf[:cls_numel].view(3, self.cls_size, self.cls_size)
+        views = buf[cls_numel:].view(self.num_views, 3, self.view_size, self.view_size)
+
+        img, cls_params = self._decode(img)
+        if self.fused_affine:
+            self._write(cls_view, self.cls_transform(img, cls_params))
+        else:
+            cls_crop = self._crop(img, self.cls_size, self.cls_scale, self.cls_ratio, cls_params)
+            self._write(cls_view, self.cls_transform(cls_crop))
+        small = self._downsample(img)
+        for k in range(self.num_views):
+            if self.fused_affine:
+                self._write(views[k], self.view_transform(small))
+            else:
+                view_crop = self._crop(small, self.view_size, self.view_scale, self.view_ratio)
+                self._write(views[k], self.view_transform(view_crop))
+        return [cls_view] + list(views.unbind(0))
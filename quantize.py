@@ -0,0 +1,125 @@
+"""Post-training static INT8 quantization of a trained `bcl_ckpt.pth.tar` for CPU inference.
+
+The BN-folded `InferenceModel` is quantized with FX graph mode: conv + relu are fused and the
+encoder runs in INT8, while the cosine classifier (`fc`) and the feature normalization stay in
+float. Activation ranges are calibrated on class-balanced batches of the training set
+(`ClassBalancedBatchSampler`), so tail classes weigh as much as head classes in the observed
+statistics. The report puts overall and many / medium / few-shot accuracy of the float and
+INT8 models next to their latency.
+
+    python quantize.py log/<store_name>/bcl_ckpt.best.pth.tar --data /path/to/imagenet --out bcl_int8.pt
+"""
+import argparse
+import copy
+
+import numpy as np
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+from dataset.imagenet import ImageNetLT
+from dataset.inat import INaturalist
+from dataset.packed import PackedImageNetLT, PackedINaturalist
+from dataset.sampler import ClassBalancedBatchSampler
+from export import benchmark
+from models.inference import InferenceModel, load_bcl_checkpoint
+from utils import ShotAccuracy, val_transform
+
+MANIFESTS = {
+    'imagenet': ('dataset/ImageNet_LT/ImageNet_LT_train.txt', 'dataset/ImageNet_LT/ImageNet_LT_val.txt'),
+    'inat': ('dataset/iNaturalist18/iNaturalist18_train.txt', 'dataset/iNaturalist18/iNaturalist18_val.txt'),
+}
+
+parser = argparse.ArgumentParser(description='INT8 post-training quantization')
+parser.add_argument('checkpoint', help='bcl_ckpt.pth.tar written by main.py')
+parser.add_argument('--arch', default=None, choices=['resnet50', 'resnext50'],
+                    help='encoder, if the checkpoint does not record it')
+parser.add_argument('--dataset', default='imagenet', choices=['inat', 'imagenet'])
+parser.add_argument('--data', default='/DATACENTER/raid5/zjg/imagenet', metavar='DIR')
+parser.add_argument('--packed', default='', type=str, metavar='DIR',
+                    help='read images from shards written by dataset/packed.py in DIR instead of --data')
+parser.add_argument('--backend', default='x86', choices=['x86', 'fbgemm', 'qnnpack', 'onednn'])
+parser.add_argument('--calib_batches', default=32, type=int, help='class-balanced calibration batches')
+parser.add_argument('--val_batches', default=0, type=int, help='evaluate on this many val batches (0: all)')
+parser.add_argument('-b', '--batch-size', default=64, type=int, dest='batch_size')
+parser.add_argument('-j', '--workers', default=8, type=int)
+parser.add_argument('--seed', default=0, type=int, help='seed of the calibration sampler')
+parser.add_argument('--out', default='', help='save the INT8 model as TorchScript here')
+parser.add_argument('--batch_sizes', default=[1, 32], type=int, nargs='+', help='batch sizes for the latency report')
+parser.add_argument('--iters', default=20, type=int, help='timed iterations per batch size')
+parser.add_argument('--threads', default=None, type=int, help='torch intra-op threads')
+
+
+def quantize(engine, calib_loader, num_batches, backend='x86'):
+    """INT8 copy of an `InferenceModel`, calibrated on `num_batches` batches of `calib_loader`."""
+    torch.backends.quantized.engine = backend
+    qconfig_mapping = get_default_qconfig_mapping(backend).set_module_name('fc', None)
+    example = next(iter(calib_loader))[0]
+    prepared = prepare_fx(copy.deepcopy(engine).eval(), qconfig_mapping, example_inputs=(example,))
+    with torch.no_grad():
+        for i, (images, _) in enumerate(calib_loader):
+            if i >= num_batches:
+                break
+            prepared(images)
+    return convert_fx(prepared)
+
+
+def evaluate(model, loader, num_batches=0):
+    """(predictions, labels) of `model` over `loader`, or its first `num_batches` batches."""
+    preds, labels = [], []
+    with torch.no_grad():
+        for i, (images, targets) in enumerate(loader):
+            if num_batches and i >= num_batches:
+                break
+            preds.append(model(images).argmax(dim=1))
+            labels.append(targets)
+    return torch.cat(preds), torch.cat(labels)
+
+
+def main():
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    model, checkpoint = load_bcl_checkpoint(args.checkpoint, args.arch)
+    engine = InferenceModel(model).eval()
+
+    if args.packed:
+        dataset_cls = PackedINaturalist if args.dataset == 'inat' else PackedImageNetLT
+        data_root = args.packed
+    else:
+        dataset_cls = INaturalist if args.dataset == 'inat' else ImageNetLT
+        data_root = args.data
+    txt_train, txt_val = MANIFESTS[args.dataset]
+    transform = val_transform(args.dataset)
+    calib_dataset = dataset_cls(root=data_root, txt=txt_train, transform=transform, train=False)
+    val_dataset = dataset_cls(root=data_root, txt=txt_val, transform=transform, train=False)
+    calib_sampler = ClassBalancedBatchSampler(calib_dataset.manifest, args.batch_size, drop_last=True, seed=args.seed)
+    calib_loader = torch.utils.data.DataLoader(calib_dataset, batch_sampler=calib_sampler, num_workers=args.workers)
+    val_loader = torch.utils.data.DataLoader(val_dataset, batch_size=args.batch_size, shuffle=False,
+                                             num_workers=args.workers)
+
+    quantized = quantize(engine, calib_loader, args.calib_batches, args.backend)
+    with torch.no_grad():
+        example = torch.randn(2, 3, 224, 224)
+        quantized = torch.jit.freeze(torch.jit.trace(quantized, example))
+    if args.out:
+        quantized.save(args.out)
+        print('=> saved INT8 TorchScript to {}'.format(args.out))
+
+    shot_accuracy = ShotAccuracy(checkpoint.get('cls_num_list', calib_dataset.cls_num_list))
+    print('{:<8}{:>8}{:>8}{:>8}{:>8}'.format('model', 'top1', 'many', 'med', 'few') +
+          ''.join('{:>16}'.format('ms @ {}'.format(b)) for b in args.batch_sizes) + '{:>10}'.format('speedup'))
+    reference = None
+    for name, m in (('fp32', engine), ('int8', quantized)):
+        preds, labels = evaluate(m, val_loader, args.val_batches)
+        top1 = (preds == labels).float().mean().item() * 100
+        many, med, few = shot_accuracy(preds, labels)
+        latency = [benchmark(m, b, 224, args.iters)[0] for b in args.batch_sizes]
+        reference = reference or latency
+        print('{:<8}{:>8.2f}{:>8.2f}{:>8.2f}{:>8.2f}'.format(name, top1, many * 100, med * 100, few * 100) +
+              ''.join('{:>16.2f}'.format(ms) for ms in latency) +
+              '{:>10.2f}'.format(float(np.mean(np.asarray(reference) / np.asarray(latency)))))
+
+
+if __name__ == '__main__':
+    main()
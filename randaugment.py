@@ -12,7 +12,7 @@ import PIL
 import numpy as np
 
 import torch
-import torch.nn as nn
+import torch.nn.functional as F
 import torchvision.transforms as transforms
 
 _PIL_VER = tuple([int(x) for x in PIL.__version__.split('.')[:2]])
@@ -285,6 +285,7 @@ class AutoAugmentOp:
 
     def __init__(self, name, prob=0.5, magnitude=10, hparams=None):
         hparams = hparams or _HPARAMS_DEFAULT
+        self.name = name
         self.aug_fn = NAME_TO_OP[name]
         self.level_fn = LEVEL_TO_ARG[name]
         self.prob = prob
@@ -301,14 +302,20 @@ class AutoAugmentOp:
         # NOTE This is my own hack, being tested, not in papers or reference impls.
         self.magnitude_std = self.hparams.get('magnitude_std', 0)
 
-    def __call__(self, img):
+    def sample(self):
+        """Draw the coin flip and magnitude, returns the op arguments or None if the op is skipped"""
         if random.random() > self.prob:
-            return img
+            return None
         magnitude = self.magnitude
         if self.magnitude_std and self.magnitude_std > 0:
             magnitude = random.gauss(magnitude, self.magnitude_std)
         magnitude = min(_MAX_LEVEL, max(0, magnitude)) # clip to valid range
-        level_args = self.level_fn(magnitude, self.hparams) if self.level_fn is not None else tuple()
+        return self.level_fn(magnitude, self.hparams) if self.level_fn is not None else tuple()
+
+    def __call__(self, img):
+        level_args = self.sample()
+        if level_args is None:
+            return img
         return self.aug_fn(img, *level_args, **self.kwargs)
 
 
@@ -396,31 +403,19 @@ class RandAugment:
         self.num_layers = num_layers
         self.choice_weights = choice_weights
 
-    def __call__(self, img):
+    def sample_ops(self):
         # no replacement when using weighted choice
-        ops = np.random.choice(
+        return np.random.choice(
             self.ops, self.num_layers, replace=self.choice_weights is None, p=self.choice_weights)
-        for op in ops:
+
+    def __call__(self, img):
+        for op in self.sample_ops():
             img = op(img)
         return img
 
 
-def rand_augment_transform(config_str, hparams, use_cmc=False):
-    """
-    Create a RandAugment transform
-    :param config_str: String defining configuration of random augmentation. Consists of multiple sections separated by
-    dashes ('-'). The first section defines the specific variant of rand augment (currently only 'rand'). The remaining
-    sections, not order sepecific determine
-        'm' - integer magnitude of rand augment
-        'n' - integer num layers (number of transform ops selected per image)
-        'w' - integer probabiliy weight index (index of a set of weights to influence choice of op)
-        'mstd' -  float std deviation of magnitude noise applied
-    Ex 'rand-m9-n3-mstd0.5' results in RandAugment with magnitude 9, num_layers 3, magnitude_std 0.5
-    'rand-mstd1-w0' results in magnitude_std 1.0, weights 0, default magnitude of 10 and num_layers 2
-    :param hparams: Other hparams (kwargs) for the RandAugmentation scheme
-    :param use_cmc: Flag indicates removing augmentation for coloring ops.
-    :return: A PyTorch compatible Transform
-    """
+def _parse_rand_config(config_str, hparams):
+    """Parse a 'rand-m9-n3-mstd0.5' style config, see `rand_augment_transform`."""
     magnitude = _MAX_LEVEL  # default to _MAX_LEVEL for magnitude (currently 10)
     num_layers = 2  # default to 2 ops per image
     weight_idx = None  # default to no probability weights for op choice
@@ -443,6 +438,26 @@ def rand_augment_transform(config_str, hparams, use_cmc=False):
             weight_idx = int(val)
         else:
             assert False, 'Unknown RandAugment config section'
+    return magnitude, num_layers, weight_idx
+
+
+def rand_augment_transform(config_str, hparams, use_cmc=False):
+    """
+    Create a RandAugment transform
+    :param config_str: String defining configuration of random augmentation. Consists of multiple sections separated by
+    dashes ('-'). The first section defines the specific variant of rand augment (currently only 'rand'). The remaining
+    sections, not order sepecific determine
+        'm' - integer magnitude of rand augment
+        'n' - integer num layers (number of transform ops selected per image)
+        'w' - integer probabiliy weight index (index of a set of weights to influence choice of op)
+        'mstd' -  float std deviation of magnitude noise applied
+    Ex 'rand-m9-n3-mstd0.5' results in RandAugment with magnitude 9, num_layers 3, magnitude_std 0.5
+    'rand-mstd1-w0' results in magnitude_std 1.0, weights 0, default magnitude of 10 and num_layers 2
+    :param hparams: Other hparams (kwargs) for the RandAugmentation scheme
+    :param use_cmc: Flag indicates removing augmentation for coloring ops.
+    :return: A PyTorch compatible Transform
+    """
+    magnitude, num_layers, weight_idx = _parse_rand_config(config_str, hparams)
     if use_cmc:
         ra_ops = rand_augment_ops_cmc(magnitude=magnitude, hparams=hparams)
     else:
@@ -451,43 +466,324 @@ def rand_augment_transform(config_str, hparams, use_cmc=False):
     return RandAugment(ra_ops, num_layers, choice_weights=choice_weights)
 
 
-class GaussianBlur(object):
-    """blur a single image on CPU"""
-    def __init__(self, kernel_size):
-        radias = kernel_size // 2
-        kernel_size = radias * 2 + 1
-        self.blur_h = nn.Conv2d(3, 3, kernel_size=(kernel_size, 1),
-                                stride=1, padding=0, bias=False, groups=3)
-        self.blur_v = nn.Conv2d(3, 3, kernel_size=(1, kernel_size),
-                                stride=1, padding=0, bias=False, groups=3)
-        self.k = kernel_size
-        self.r = radias
-
-        self.blur = nn.Sequential(
-            nn.ReflectionPad2d(radias),
-            self.blur_h,
-            self.blur_v
-        )
+# Batched tensor backend
+#
+# The same op set and level-to-arg mappings as above, applied to a whole uint8 batch (N, 3, H, W).
+# Ops, application coin flips and magnitudes are drawn per sample with vectorized RNG, and every op
+# runs once on all the samples that picked it. Colour ops follow the PIL integer arithmetic (blend
+# truncation, ITU-R 601-2 luma), geometric ops sample PIL pixel centres and fill like `Image.transform`.
 
-        self.pil_to_tensor = transforms.ToTensor()
-        self.tensor_to_pil = transforms.ToPILImage()
+def _batch_negate(level, generator):
+    sign = torch.rand(level.shape, generator=generator, device=level.device) > 0.5
+    return torch.where(sign, -level, level)
 
-    def __call__(self, img):
-        img = self.pil_to_tensor(img).unsqueeze(0)
 
-        sigma = np.random.uniform(0.1, 2.0)
-        x = np.arange(-self.r, self.r + 1)
-        x = np.exp(-np.power(x, 2) / (2 * sigma * sigma))
-        x = x / x.sum()
-        x = torch.from_numpy(x).view(1, -1).repeat(3, 1)
+def _batch_level_to_arg(name, level, hparams, generator):
+    """Vectorized `LEVEL_TO_ARG[name]` over a float tensor of levels."""
+    if name == 'Rotate':
+        return _batch_negate(level / _MAX_LEVEL * 30., generator)
+    if name in ('Color', 'Contrast', 'Brightness', 'Sharpness'):
+        return level / _MAX_LEVEL * 1.8 + 0.1
+    if name in ('ShearX', 'ShearY'):
+        return _batch_negate(level / _MAX_LEVEL * 0.3, generator)
+    if name in ('TranslateX', 'TranslateY'):
+        return _batch_negate(level / _MAX_LEVEL * float(hparams['translate_const']), generator)
+    if name in ('TranslateXRel', 'TranslateYRel'):
+        return _batch_negate(level / _MAX_LEVEL * 0.45, generator)
+    if name == 'PosterizeOriginal':
+        return (level / _MAX_LEVEL * 4).long() + 4
+    if name == 'PosterizeResearch':
+        return 4 - (level / _MAX_LEVEL * 4).long()
+    if name == 'PosterizeTpu':
+        return (level / _MAX_LEVEL * 4).long()
+    if name == 'Solarize':
+        return (level / _MAX_LEVEL * 256).long()
+    if name == 'SolarizeAdd':
+        return (level / _MAX_LEVEL * 110).long()
+    return None
 
-        self.blur_h.weight.data.copy_(x.view(3, 1, self.k, 1))
-        self.blur_v.weight.data.copy_(x.view(3, 1, 1, self.k))
 
-        with torch.no_grad():
-            img = self.blur(img)
-            img = img.squeeze()
+def _bcast(arg):
+    return arg.view(-1, 1, 1, 1)
 
-        img = self.tensor_to_pil(img)
 
-        return img
+def _batch_blend(degenerate, x, factor):
+    # Image.blend: truncate towards zero, clip when extrapolating
+    out = degenerate + _bcast(factor) * (x.float() - degenerate)
+    return out.clamp_(0, 255).trunc_().to(torch.uint8)
+
+
+def _batch_luma(x):
+    # PIL "RGB" -> "L": (R * 19595 + G * 38470 + B * 7471 + 0x8000) >> 16
+    x = x.int()
+    return (x[:, 0:1] * 19595 + x[:, 1:2] * 38470 + x[:, 2:3] * 7471 + 0x8000) >> 16
+
+
+def _batch_histogram(x):
+    n, c = x.shape[:2]
+    flat = x.reshape(n * c, -1).long()
+    hist = torch.zeros(n * c, 256, dtype=torch.long, device=x.device)
+    return hist.scatter_add_(1, flat, torch.ones_like(flat)), flat
+
+
+def _batch_auto_contrast(x, _arg, **__):
+    hist, flat = _batch_histogram(x)
+    present = hist > 0
+    levels = torch.arange(256, device=x.device)
+    lo = torch.where(present, levels, 256).min(1, keepdim=True)[0]
+    hi = torch.where(present, levels, -1).max(1, keepdim=True)[0]
+    scale = 255.0 / (hi - lo).clamp(min=1)
+    lut = (levels * scale - lo * scale).trunc().clamp(0, 255).long()
+    lut = torch.where(hi <= lo, levels, lut)
+    return lut.gather(1, flat).view_as(x).to(torch.uint8)
+
+
+def _batch_equalize(x, _arg, **__):
+    hist, flat = _batch_histogram(x)
+    levels = torch.arange(256, device=x.device)
+    last = hist.gather(1, torch.where(hist > 0, levels, -1).max(1, keepdim=True)[0])
+    step = (hist.sum(1, keepdim=True) - last) // 255
+    n = step // 2 + hist.cumsum(1) - hist
+    lut = (n // step.clamp(min=1)).clamp(max=255)
+    lut = torch.where(step == 0, levels, lut)
+    return lut.gather(1, flat).view_as(x).to(torch.uint8)
+
+
+def _batch_invert(x, _arg, **__):
+    return 255 - x
+
+
+def _batch_identity(x, _arg, **__):
+    return x
+
+
+def _batch_posterize(x, bits, **__):
+    mask = (0xFF << (8 - bits.clamp(max=8))) & 0xFF
+    return x & _bcast(mask).to(torch.uint8)
+
+
+def _batch_solarize(x, thresh, **__):
+    return torch.where(x < _bcast(thresh), x, 255 - x)
+
+
+def _batch_solarize_add(x, add, thresh=128, **__):
+    added = (x.int() + _bcast(add)).clamp(max=255).to(torch.uint8)
+    return torch.where(x < thresh, added, x)
+
+
+def _batch_color(x, factor, **__):
+    return _batch_blend(_batch_luma(x).float(), x, factor)
+
+
+def _batch_contrast(x, factor, **__):
+    mean = (_batch_luma(x).float().mean(dim=(1, 2, 3), keepdim=True) + 0.5).trunc()
+    return _batch_blend(mean, x, factor)
+
+
+def _batch_brightness(x, factor, **__):
+    return _batch_blend(torch.zeros((), device=x.device), x, factor)
+
+
+def _batch_sharpness(x, factor, **__):
+    # ImageFilter.SMOOTH, border pixels are left untouched like ImagingFilter
+    kernel = torch.tensor([[1., 1., 1.], [1., 5., 1.], [1., 1., 1.]], device=x.device) / 13.
+    smooth = F.conv2d(x.float(), kernel.expand(3, 1, 3, 3), groups=3).add_(0.5).trunc_().clamp_(0, 255)
+    degenerate = x.float()
+    degenerate[:, :, 1:-1, 1:-1] = smooth
+    return _batch_blend(degenerate, x, factor)
+
+
+def _batch_affine(x, matrix, fillcolor=_FILL, resample=_RANDOM_INTERPOLATION, **__):
+    """`Image.transform(size, AFFINE, matrix)` for a batch of (N, 2, 3) output->input matrices."""
+    n, _, h, w = x.shape
+    # like `_check_args_tf`, every image draws its own interpolation
+    resample = [random.choice(resample) for _ in range(n)] if isinstance(resample, (list, tuple)) else [resample] * n
+    ys, xs = torch.meshgrid(torch.arange(h, device=x.device, dtype=torch.float32) + 0.5,
+                            torch.arange(w, device=x.device, dtype=torch.float32) + 0.5, indexing='ij')
+    centres = torch.stack([xs, ys, torch.ones_like(xs)], dim=-1).view(1, h * w, 3)
+    src = centres.matmul(matrix.float().transpose(1, 2)).view(n, h, w, 2)
+    inside = ((src[..., 0] >= 0) & (src[..., 0] < w) & (src[..., 1] >= 0) & (src[..., 1] < h)).unsqueeze(1)
+    grid = torch.stack([src[..., 0] / w, src[..., 1] / h], dim=-1) * 2 - 1
+    out = torch.empty(x.shape, dtype=torch.float32, device=x.device)
+    for r in set(resample):
+        mode = 'bicubic' if r == Image.BICUBIC else 'nearest' if r == Image.NEAREST else 'bilinear'
+        idx = torch.tensor([k for k in range(n) if resample[k] == r], device=x.device)
+        out[idx] = F.grid_sample(x[idx].float(), grid[idx], mode=mode, padding_mode='border', align_corners=False)
+    fill = torch.tensor(fillcolor, dtype=torch.float32, device=x.device).view(1, 3, 1, 1)
+    out = torch.where(inside, out.round_().clamp_(0, 255), fill)
+    return out.to(torch.uint8)
+
+
+def _affine_matrix(a, b, c, d, e, f):
+    return torch.stack([torch.stack([a, b, c], dim=-1), torch.stack([d, e, f], dim=-1)], dim=1)
+
+
+def _batch_shear_x(x, factor, **kwargs):
+    one, zero = torch.ones_like(factor), torch.zeros_like(factor)
+    return _batch_affine(x, _affine_matrix(one, factor, zero, zero, one, zero), **kwargs)
+
+
+def _batch_shear_y(x, factor, **kwargs):
+    one, zero = torch.ones_like(factor), torch.zeros_like(factor)
+    return _batch_affine(x, _affine_matrix(one, zero, zero, factor, one, zero), **kwargs)
+
+
+def _batch_translate_x_abs(x, pixels, **kwargs):
+    one, zero = torch.ones_like(pixels), torch.zeros_like(pixels)
+    return _batch_affine(x, _affine_matrix(one, zero, pixels, zero, one, zero), **kwargs)
+
+
+def _batch_translate_y_abs(x, pixels, **kwargs):
+    one, zero = torch.ones_like(pixels), torch.zeros_like(pixels)
+    return _batch_affine(x, _affine_matrix(one, zero, zero, zero, one, pixels), **kwargs)
+
+
+def _batch_translate_x_rel(x, pct, **kwargs):
+    return _batch_translate_x_abs(x, pct * x.shape[3], **kwargs)
+
+
+def _batch_translate_y_rel(x, pct, **kwargs):
+    return _batch_translate_y_abs(x, pct * x.shape[2], **kwargs)
+
+
+def _batch_rotate(x, degrees, **kwargs):
+    # same reverse matrix as Image.rotate around the image centre
+    cx, cy = x.shape[3] / 2.0, x.shape[2] / 2.0
+    angle = -torch.deg2rad(degrees.double())
+    cos, sin = torch.cos(angle), torch.sin(angle)
+    c = cos * -cx + sin * -cy + cx
+    f = -sin * -cx + cos * -cy + cy
+    return _batch_affine(x, _affine_matrix(cos, sin, c, -sin, cos, f), **kwargs)
+
+
+BATCH_NAME_TO_OP = {
+    'AutoContrast': _batch_auto_contrast,
+    'Equalize': _batch_equalize,
+    'Invert': _batch_invert,
+    'Identity': _batch_identity,
+    'Rotate': _batch_rotate,
+    'PosterizeOriginal': _batch_posterize,
+    'PosterizeResearch': _batch_posterize,
+    'PosterizeTpu': _batch_posterize,
+    'Solarize': _batch_solarize,
+    'SolarizeAdd': _batch_solarize_add,
+    'Color': _batch_color,
+    'Contrast': _batch_contrast,
+    'Brightness': _batch_brightness,
+    'Sharpness': _batch_sharpness,
+    'ShearX': _batch_shear_x,
+    'ShearY': _batch_shear_y,
+    'TranslateX': _batch_translate_x_abs,
+    'TranslateY': _batch_translate_y_abs,
+    'TranslateXRel': _batch_translate_x_rel,
+    'TranslateYRel': _batch_translate_y_rel,
+}
+
+
+class BatchRandAugment:
+    """RandAugment over a uint8 batch (N, 3, H, W), each sample with its own ops and magnitudes"""
+
+    def __init__(self, names, magnitude=10, num_layers=2, prob=0.5, hparams=None, choice_weights=None,
+                 generator=None):
+        hparams = hparams or _HPARAMS_DEFAULT
+        self.names = list(names)
+        self.magnitude = magnitude
+        self.num_layers = num_layers
+        self.prob = prob
+        self.hparams = hparams.copy()
+        self.magnitude_std = self.hparams.get('magnitude_std', 0)
+        self.choice_weights = None if choice_weights is None else torch.as_tensor(choice_weights, dtype=torch.float)
+        self.generator = generator
+        self.kwargs = dict(
+            fillcolor=hparams['img_mean'] if 'img_mean' in hparams else _FILL,
+            resample=hparams['interpolation'] if 'interpolation' in hparams else _RANDOM_INTERPOLATION,
+        )
+
+    def _choose_ops(self, n):
+        if self.choice_weights is None:
+            return torch.randint(len(self.names), (n, self.num_layers), generator=self.generator)
+        # weighted choice without replacement, Gumbel top-k per sample
+        u = torch.rand(n, len(self.names), generator=self.generator).clamp_(min=1e-12)
+        keys = self.choice_weights.log() - (-u.log()).log()
+        return keys.topk(self.num_layers, dim=1)[1]
+
+    def __call__(self, x):
+        n = x.shape[0]
+        ops = self._choose_ops(n)
+        applied = torch.rand(n, self.num_layers, generator=self.generator) <= self.prob
+        magnitude = torch.full((n, self.num_layers), float(self.magnitude))
+        if self.magnitude_std and self.magnitude_std > 0:
+            magnitude += torch.randn(n, self.num_layers, generator=self.generator) * self.magnitude_std
+        magnitude = magnitude.clamp_(0, _MAX_LEVEL)  # clip to valid range
+
+        x = x.clone()
+        for layer in range(self.num_layers):
+            for k, name in enumerate(self.names):
+                idx = torch.nonzero((ops[:, layer] == k) & applied[:, layer]).squeeze(1)
+                if idx.numel() == 0:
+                    continue
+                arg = _batch_level_to_arg(name, magnitude[idx, layer], self.hparams, self.generator)
+                if arg is not None:
+                    arg = arg.to(x.device)
+                idx = idx.to(x.device)
+                x[idx] = BATCH_NAME_TO_OP[name](x[idx], arg, **self.kwargs)
+        return x
+
+
+def rand_augment_batch_transform(config_str, hparams, use_cmc=False, generator=None):
+    """
+    Create a `BatchRandAugment` for uint8 tensor batches from the same config string as `rand_augment_transform`.
+    """
+    magnitude, num_layers, weight_idx = _parse_rand_config(config_str, hparams)
+    names = _RAND_TRANSFORMS_CMC if use_cmc else _RAND_TRANSFORMS
+    choice_weights = None if weight_idx is None else _select_rand_weights(weight_idx, names)
+    return BatchRandAugment(names, magnitude=magnitude, num_layers=num_layers, hparams=hparams,
+                            choice_weights=choice_weights, generator=generator)
+
+
+class GaussianBlur(object):
+    """Gaussian blur with a random sigma per image, for PIL images, uint8 HWC arrays or (N, )C, H, W tensors.
+
+    Sigma is quantized to `num_sigmas` levels in `sigma` and the separable kernels are built
+    once. A batch is blurred with one grouped convolution per axis, every image with its own
+    kernel.
+    """
+    def __init__(self, kernel_size, sigma=(0.1, 2.0), num_sigmas=32):
+        self.r = kernel_size // 2
+        self.k = self.r * 2 + 1
+        self.sigmas = np.linspace(sigma[0], sigma[1], num_sigmas)
+        x = np.arange(-self.r, self.r + 1)
+        kernels = np.exp(-np.power(x, 2)[None] / (2 * self.sigmas[:, None] ** 2))
+        self.kernels = torch.from_numpy(kernels / kernels.sum(1, keepdims=True)).float()
+
+    def sample(self, n):
+        """Indices into `self.kernels` for `n` images, uniform over the sigma range."""
+        sigma = np.random.uniform(self.sigmas[0], self.sigmas[-1], n)
+        return torch.from_numpy(np.rint((sigma - self.sigmas[0]) / (self.sigmas[-1] - self.sigmas[0] + 1e-12)
+                                        * (len(self.sigmas) - 1)).astype(np.int64))
+
+    def blur(self, x, idx):
+        """Blur float (N, C, H, W) `x`, image `i` with kernel `idx[i]`."""
+        n, c, h, w = x.shape
+        kernel = self.kernels.to(x.device)[idx.to(x.device)].repeat_interleave(c, 0)
+        x = F.pad(x.reshape(1, n * c, h, w), (self.r, self.r, self.r, self.r), mode='reflect')
+        x = F.conv2d(x, kernel.view(n * c, 1, self.k, 1), groups=n * c)
+        x = F.conv2d(x, kernel.view(n * c, 1, 1, self.k), groups=n * c)
+        return x.view(n, c, h, w)
+
+    def __call__(self, img):
+        if isinstance(img, Image.Image):
+            return Image.fromarray(self(np.array(img)))
+        if isinstance(img, np.ndarray):
+            # uint8 H, W(, C)
+            x = torch.from_numpy(np.ascontiguousarray(img))
+            x = x.view(x.shape[0], x.shape[1], -1).permute(2, 0, 1)
+            return self(x).permute(1, 2, 0).reshape(img.shape).numpy()
+        batched = img.dim() == 4
+        x = img if batched else img.unsqueeze(0)
+        with torch.no_grad():
+            out = self.blur(x.float(), self.sample(x.shape[0]))
+        if not img.is_floating_point():
+            out = out.round_().clamp_(0, 255)
+        out = out.to(img.dtype)
+        return out if batched else out.squeeze(0)
@@ -0,0 +1,231 @@
+"""Local inference server for a trained `bcl_ckpt.pth.tar`, over HTTP or a Unix socket.
+
+    python serve.py log/<store_name>/bcl_ckpt.best.pth.tar --port 8000
+    python serve.py log/<store_name>/bcl_ckpt.best.pth.tar --unix /tmp/cbts.sock
+
+`POST /predict` takes one encoded image as the request body and answers
+`{"classes": [...], "scores": [...]}`, the top-k classes and their softmax probabilities;
+`?k=` overrides `--topk`. `GET /health` answers `ok`.
+
+Requests are decoded and preprocessed like the validation set (`utils.val_transform`) in a
+thread pool, then `MicroBatcher` runs them through the BN-folded `InferenceModel` in batches
+of up to `--max_batch`, waiting at most `--max_delay_ms` after the first request of a batch.
+With `--tau`, logits are adjusted post hoc by `- tau * log(prior)`, the prior being the
+training class frequencies `cls_num_list` stored in the checkpoint.
+"""
+import argparse
+import io
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+from dataset.decode import decode
+from models.inference import build_inference_model
+from utils import VAL_DRAFT_SIZE, val_transform
+
+parser = argparse.ArgumentParser(description='CBTS inference server')
+parser.add_argument('checkpoint', help='bcl_ckpt.pth.tar written by main.py')
+parser.add_argument('--arch', default=None, choices=['resnet50', 'resnext50'],
+                    help='encoder, if the checkpoint does not record it')
+parser.add_argument('--dataset', default='imagenet', choices=['imagenet', 'inat'], help='normalization to use')
+parser.add_argument('--host', default='127.0.0.1')
+parser.add_argument('--port', default=8000, type=int)
+parser.add_argument('--unix', default='', help='listen on this Unix socket instead of TCP')
+parser.add_argument('--max_batch', default=32, type=int, help='largest micro-batch')
+parser.add_argument('--max_delay_ms', default=10., type=float,
+                    help='longest a request waits for its micro-batch to fill')
+parser.add_argument('--decode_workers', default=4, type=int, help='image decoding threads')
+parser.add_argument('--topk', default=5, type=int)
+parser.add_argument('--tau', default=0., type=float,
+                    help='subtract tau * log(class prior) from the logits (0: off)')
+parser.add_argument('--jpeg_draft', action='store_true', help='decode JPEGs at reduced DCT scale')
+parser.add_argument('--threads', default=None, type=int, help='torch intra-op threads')
+
+
+class Predictor(object):
+    """Logits -> top-k (classes, probabilities), optionally logit-adjusted by the training prior."""
+
+    def __init__(self, model, cls_num_list=None, tau=0.):
+        self.model = model
+        self.adjustment = None
+        if tau:
+            if cls_num_list is None:
+                raise ValueError('--tau needs cls_num_list, the checkpoint does not store it')
+            # a class without training images would get an infinite boost
+            prior = torch.tensor(cls_num_list, dtype=torch.float).clamp(min=1)
+            self.adjustment = tau * torch.log(prior / prior.sum())
+
+    def __call__(self, images, ks):
+        with torch.no_grad():
+            logits = self.model(images)
+            if self.adjustment is not None:
+                logits = logits - self.adjustment
+            probs, classes = F.softmax(logits, dim=1).topk(max(ks), dim=1)
+        return [{'classes': c[:k].tolist(), 'scores': p[:k].tolist()} for c, p, k in zip(classes, probs, ks)]
+
+
+class MicroBatcher(object):
+    """Collects submitted inputs into batches of up to `max_batch`, closing a batch at the latest
+    `max_delay` seconds after its first input, and runs `predict` on them in one thread."""
+
+    def __init__(self, predict, max_batch=32, max_delay=0.01):
+        self.predict = predict
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, image, k):
+        future = Future()
+        self.queue.put((image, k, future))
+        return future
+
+    def _collect(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            images, ks, futures = zip(*batch)
+            try:
+                results = self.predict(torch.stack(images), ks)
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            for future, result in zip(futures, results):
+                future.set_result(result)
+
+
+class Server(object):
+    """Decoding pool + micro-batcher shared by the request handlers."""
+
+    def __init__(self, predictor, transform, max_batch, max_delay, decode_workers, topk, num_classes,
+                 draft_size=None):
+        self.transform = transform
+        self.topk = topk
+        self.num_classes = num_classes
+        self.draft_size = draft_size
+        self.decoder = ThreadPoolExecutor(decode_workers)
+        self.batcher = MicroBatcher(predictor, max_batch, max_delay)
+
+    def _preprocess(self, data):
+        img = decode(Image.open(io.BytesIO(data)), self.draft_size)
+        return self.transform(img)
+
+    def check_k(self, k):
+        """`k` (0: `topk`) if it is a valid number of classes to answer, else ValueError."""
+        k = k or self.topk
+        if not 1 <= k <= self.num_classes:
+            raise ValueError('k must be in [1, {}], got {}'.format(self.num_classes, k))
+        return k
+
+    def predict(self, data, k=None):
+        # validated here, an invalid k would fail the whole micro-batch in the model thread
+        k = self.check_k(k)
+        image = self.decoder.submit(self._preprocess, data).result()
+        return self.batcher.submit(image, k).result()
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _reply(self, code, body, content_type='application/json'):
+        body = body.encode()
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/health':
+            self._reply(200, 'ok', 'text/plain')
+        else:
+            self._reply(404, json.dumps({'error': 'not found'}))
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if url.path != '/predict':
+            self._reply(404, json.dumps({'error': 'not found'}))
+            return
+        try:
+            k = int(parse_qs(url.query).get('k', [0])[0])
+            result = self.server.app.predict(data, k)
+        except (OSError, ValueError) as e:
+            # unreadable image or bad query
+            self._reply(400, json.dumps({'error': str(e)}))
+            return
+        except Exception as e:
+            self._reply(500, json.dumps({'error': '{}: {}'.format(type(e).__name__, e)}))
+            return
+        self._reply(200, json.dumps(result))
+
+    def address_string(self):
+        # Unix socket peers have no address
+        return self.client_address[0] if self.client_address else self.server.server_address
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def main():
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    model, checkpoint = build_inference_model(args.checkpoint, args.arch)
+    with torch.no_grad():
+        num_classes = model(torch.zeros(1, 3, 224, 224)).shape[1]
+    if not 1 <= args.topk <= num_classes:
+        parser.error('--topk must be in [1, {}]'.format(num_classes))
+    predictor = Predictor(model, checkpoint.get('cls_num_list'), args.tau)
+    app = Server(predictor, val_transform(args.dataset), args.max_batch, args.max_delay_ms / 1000.,
+                 args.decode_workers, args.topk, num_classes, VAL_DRAFT_SIZE if args.jpeg_draft else None)
+
+    if args.unix:
+        if os.path.exists(args.unix):
+            os.unlink(args.unix)
+        httpd = UnixHTTPServer(args.unix, Handler)
+        where = 'unix:{}'.format(args.unix)
+    else:
+        httpd = ThreadingHTTPServer((args.host, args.port), Handler)
+        where = 'http://{}:{}'.format(args.host, args.port)
+    httpd.app = app
+    print("=> serving '{}' on {} (max batch {}, max delay {} ms)".format(
+        args.checkpoint, where, args.max_batch, args.max_delay_ms))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+
+
+if __name__ == '__main__':
+    main()
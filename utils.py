@@ -2,6 +2,29 @@ import random
 from PIL import ImageFilter
 import numpy as np
 import torch
+import torch.distributed as dist
+import torch.nn.functional as F
+from torchvision.transforms import transforms
+
+# val_transform starts with Resize(256), so a reduced JPEG decode only has to keep the shorter side >= 256
+VAL_DRAFT_SIZE = 256
+
+
+def dataset_normalize(dataset):
+    """Per-channel normalization of `dataset` ('imagenet' or 'inat')."""
+    if dataset == 'inat':
+        return transforms.Normalize((0.466, 0.471, 0.380), (0.195, 0.194, 0.192))
+    return transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225))
+
+
+def val_transform(dataset):
+    """Evaluation preprocessing of `dataset`, for validation and serving."""
+    return transforms.Compose([
+        transforms.Resize(256),
+        transforms.CenterCrop(224),
+        transforms.ToTensor(),
+        dataset_normalize(dataset)
+    ])
 
 
 class GaussianBlur(object):
@@ -16,47 +39,131 @@ class GaussianBlur(object):
         return x
 
 
+class ShotAccuracy(object):
+    """Many / medium / few-shot accuracy with the class buckets computed once from the train class counts.
+
+    Classes with more than `many_shot_thr` train images are many-shot, with fewer than
+    `low_shot_thr` few-shot, the rest medium-shot.
+    """
+
+    def __init__(self, cls_num_list, many_shot_thr=100, low_shot_thr=20):
+        self.train_class_count = np.asarray(cls_num_list, dtype=np.int64)
+        self.num_classes = len(self.train_class_count)
+        self.many = self.train_class_count > many_shot_thr
+        self.low = self.train_class_count < low_shot_thr
+        self.median = ~(self.many | self.low)
+
+    @classmethod
+    def from_labels(cls, labels, num_classes=None, **kwargs):
+        labels = np.asarray(labels, dtype=np.int64)
+        return cls(np.bincount(labels, minlength=num_classes or 0), **kwargs)
+
+    @classmethod
+    def from_checkpoint(cls, checkpoint, **kwargs):
+        """From a checkpoint dict (or path) saved with its `cls_num_list`."""
+        if isinstance(checkpoint, str):
+            checkpoint = torch.load(checkpoint, map_location='cpu')
+        return cls(checkpoint['cls_num_list'], **kwargs)
+
+    def from_counts(self, class_correct, class_total, acc_per_cls=False):
+        """Shot accuracies from per-class correct / total test counts."""
+        class_correct = np.asarray(class_correct, dtype=np.float64)
+        class_total = np.asarray(class_total, dtype=np.float64)
+        # classes without test samples are left out of every bucket
+        present = class_total > 0
+        class_acc = np.zeros(self.num_classes)
+        class_acc[present] = class_correct[present] / class_total[present]
+        res = [float(class_acc[bucket & present].mean()) if (bucket & present).any() else 0.
+               for bucket in (self.many, self.median, self.low)]
+        if acc_per_cls:
+            res.append(class_acc[present].tolist())
+        return tuple(res)
+
+    def __call__(self, preds, labels, acc_per_cls=False):
+        if isinstance(preds, torch.Tensor):
+            preds = preds.detach().cpu().numpy()
+            labels = labels.detach().cpu().numpy()
+        elif not isinstance(preds, np.ndarray):
+            raise TypeError('Type ({}) of preds not supported'.format(type(preds)))
+        labels = np.asarray(labels, dtype=np.int64)
+        class_total = np.bincount(labels, minlength=self.num_classes)
+        class_correct = np.bincount(labels, weights=preds == labels, minlength=self.num_classes)
+        return self.from_counts(class_correct, class_total, acc_per_cls=acc_per_cls)
+
+
 def shot_acc(preds, labels, train_data, many_shot_thr=100, low_shot_thr=20, acc_per_cls=False):
     if isinstance(train_data, np.ndarray):
-        training_labels = np.array(train_data).astype(int)
+        training_labels = train_data
     else:
-        training_labels = np.array(train_data.dataset.labels).astype(int)
+        training_labels = train_data.dataset.labels
+    labels_max = int(labels.max()) + 1 if len(labels) else 0
+    shot_accuracy = ShotAccuracy.from_labels(training_labels, num_classes=labels_max,
+                                             many_shot_thr=many_shot_thr, low_shot_thr=low_shot_thr)
+    return shot_accuracy(preds, labels, acc_per_cls=acc_per_cls)
 
-    if isinstance(preds, torch.Tensor):
-        preds = preds.detach().cpu().numpy()
-        labels = labels.detach().cpu().numpy()
-    elif isinstance(preds, np.ndarray):
-        pass
-    else:
-        raise TypeError('Type ({}) of preds not supported'.format(type(preds)))
-    train_class_count = []
-    test_class_count = []
-    class_correct = []
-    for l in np.unique(labels):
-        train_class_count.append(len(training_labels[training_labels == l]))
-        test_class_count.append(len(labels[labels == l]))
-        class_correct.append((preds[labels == l] == labels[labels == l]).sum())
-
-    many_shot = []
-    median_shot = []
-    low_shot = []
-    for i in range(len(train_class_count)):
-        if train_class_count[i] > many_shot_thr:
-            many_shot.append((class_correct[i] / test_class_count[i]))
-        elif train_class_count[i] < low_shot_thr:
-            low_shot.append((class_correct[i] / test_class_count[i]))
-        else:
-            median_shot.append((class_correct[i] / test_class_count[i]))
-
-    if len(many_shot) == 0:
-        many_shot.append(0)
-    if len(median_shot) == 0:
-        median_shot.append(0)
-    if len(low_shot) == 0:
-        low_shot.append(0)
-
-    if acc_per_cls:
-        class_accs = [c / cnt for c, cnt in zip(class_correct, test_class_count)]
-        return np.mean(many_shot), np.mean(median_shot), np.mean(low_shot), class_accs
-    else:
-        return np.mean(many_shot), np.mean(median_shot), np.mean(low_shot)
+
+class EvalAccumulator(object):
+    """Streaming evaluation state: per-class correct / total counts, top-k hits and the loss sum.
+
+    Everything stays on the logits' device, O(C) memory, until `compute()` reads it back in
+    one sync. With `logits_path` the logits are also written to a `.npy` memmap of shape
+    (num_samples, num_classes). `device` is where an accumulator that saw no batch (an empty
+    shard) allocates its zero counts, so `compute()` still joins the all-reduce.
+    """
+
+    def __init__(self, num_classes, topk=(1,), logits_path=None, num_samples=None, device='cpu'):
+        self.num_classes = num_classes
+        self.device = device
+        self.topk = topk
+        self.logits = None
+        if logits_path is not None:
+            self.logits = np.lib.format.open_memmap(logits_path, mode='w+', dtype=np.float32,
+                                                    shape=(num_samples, num_classes))
+        self.offset = 0
+        self.state = None
+
+    def _init(self, device):
+        self.class_correct = torch.zeros(self.num_classes, dtype=torch.long, device=device)
+        self.class_total = torch.zeros(self.num_classes, dtype=torch.long, device=device)
+        # [topk hits..., loss sum]
+        self.state = torch.zeros(len(self.topk) + 1, dtype=torch.float64, device=device)
+
+    def update(self, logits, targets, loss=None):
+        if self.state is None:
+            self._init(logits.device)
+        batch_size = targets.size(0)
+        # same prediction as softmax(...).max(dim=1) in shot_acc
+        _, preds = F.softmax(logits.detach(), dim=1).max(dim=1)
+        self.class_correct.index_add_(0, targets, (preds == targets).long())
+        self.class_total.index_add_(0, targets, torch.ones_like(targets))
+        _, pred = logits.topk(max(self.topk), 1, True, True)
+        correct = pred.eq(targets.view(-1, 1))
+        for n, k in enumerate(self.topk):
+            self.state[n] += correct[:, :k].sum()
+        if loss is not None:
+            self.state[-1] += loss.detach().double() * batch_size
+        if self.logits is not None:
+            self.logits[self.offset:self.offset + batch_size] = logits.detach().float().cpu().numpy()
+        self.offset += batch_size
+
+    def compute(self):
+        """Host-side results: `top{k}` accuracies in percent, mean `loss`, `count` and per-class counts.
+
+        Under torch.distributed the counts are summed over all ranks first.
+        """
+        if self.state is None:
+            self._init(self.device)
+        count = torch.tensor([float(self.offset)], dtype=torch.float64, device=self.state.device)
+        state = torch.cat([count, self.state, self.class_correct.double(), self.class_total.double()])
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(state)
+        count, state = int(state[0]), state[1:].cpu().numpy()
+        # plain floats, so checkpoints storing them stay loadable with torch.load(weights_only=True)
+        results = {'top{}'.format(k): float(state[n] * 100.0 / count) for n, k in enumerate(self.topk)}
+        results['loss'] = float(state[len(self.topk)] / count)
+        results['count'] = count
+        results['class_correct'] = state[len(self.topk) + 1:len(self.topk) + 1 + self.num_classes].astype(np.int64)
+        results['class_total'] = state[len(self.topk) + 1 + self.num_classes:].astype(np.int64)
+        if self.logits is not None:
+            self.logits.flush()
+        return results